@@ -0,0 +1,81 @@
+from time import time
+from logging import info, debug
+from cache import Cache
+import reddit_util
+
+class Watermarks(Cache):
+	"""
+	Creation time of the newest thing fully processed in each listing, so a
+	restart knows how far back it has to catch up.
+	"""
+	
+	def __init__(self, file=None):
+		super().__init__(file)
+		self._marks = {}
+	
+	def get(self, name):
+		return self._marks.get(name)
+	
+	def advance(self, name, things):
+		if len(things) > 0:
+			newest = max(thing.created_utc for thing in things)
+			if newest > self._marks.get(name, 0):
+				self._marks[name] = newest
+	
+	def data(self):
+		return self._marks
+	
+	def __iter__(self):
+		return self._marks.__iter__()
+
+class Backfill:
+	"""
+	Pages back through a listing from where polling left off until it
+	reaches the watermark or the maximum age, a few pages at a time so normal
+	polling carries on in between. Pages come newest first, so the most
+	recent backlog is moderated first.
+	"""
+	
+	def __init__(self, name, path, watermark, max_age):
+		self.name = name
+		self.path = path
+		self.stop_time = max(watermark, time() - max_age)
+		self.after = None
+		self.done = False
+		self.count = 0
+	
+	def seed(self, things):
+		"""
+		Starts the backfill after the oldest thing from the first poll.
+		"""
+		if self.after is not None:
+			return
+		if len(things) == 0:
+			self._finish()
+			return
+		
+		oldest = things[-1]
+		self.after = oldest.fullname
+		if oldest.created_utc <= self.stop_time:
+			self._finish()
+	
+	def next_batch(self, r, pages=1):
+		if self.done or self.after is None:
+			return []
+		
+		batch = []
+		for n in range(pages):
+			page, self.after = reddit_util.get_listing_page(r, self.path, self.after)
+			newer = [thing for thing in page if thing.created_utc > self.stop_time]
+			batch.extend(newer)
+			if len(newer) < len(page) or len(page) == 0 or self.after is None:
+				self._finish()
+				break
+		
+		self.count += len(batch)
+		debug("Backfilled {} {} so far".format(self.count, self.name))
+		return batch
+	
+	def _finish(self):
+		self.done = True
+		info("Backfill of {} complete ({} things)".format(self.name, self.count))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Benchmarks cache.ImageHashIndex lookups on a large index of random hashes and
+checks that slightly changed hashes are still found. Given image files, also
+prints their perceptual hashes and the distances between them, so fixtures
+like a resized or recompressed copy of an image can be checked by hand.
+
+Requires NumPy, and Pillow for hashing images.
+
+Usage: benchmarks/images.py [--size COUNT] [--queries COUNT] [IMAGE ...]
+"""
+
+import os, sys, random
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cache import ImageHashIndex
+
+def build_index(size, seed=1):
+	rand = random.Random(seed)
+	hashes = [rand.getrandbits(64) for n in range(size)]
+	index = ImageHashIndex(capacity=size)
+	index.add(hashes, [str(n) for n in range(size)])
+	return index, hashes
+
+def flip_bits(value, count, rand):
+	for bit in rand.sample(range(64), count):
+		value ^= 1 << bit
+	return value
+
+def benchmark(size, queries, max_distance=6):
+	rand = random.Random(2)
+	start = timer()
+	index, hashes = build_index(size)
+	print("Built index of {} hashes in {:.0f} ms".format(size, (timer() - start) * 1000))
+	
+	# Half near-duplicates of indexed hashes, half unrelated
+	planted = {}
+	batch = []
+	for n in range(queries):
+		if n % 2 == 0:
+			i = rand.randrange(size)
+			planted[n] = str(i)
+			batch.append(flip_bits(hashes[i], rand.randint(0, max_distance), rand))
+		else:
+			batch.append(rand.getrandbits(64))
+	
+	start = timer()
+	found = index.search(batch, max_distance)
+	elapsed = timer() - start
+	print("Searched {} queries in {:.1f} ms ({:.3f} ms per query)".format(queries, elapsed * 1000, elapsed * 1000 / queries))
+	
+	start = timer()
+	index.search(batch[:1], max_distance)
+	print("Single query: {:.2f} ms".format((timer() - start) * 1000))
+	
+	missed = sum(1 for n, name in planted.items() if found[n] is None or found[n][0] != name)
+	spurious = sum(1 for n in range(queries) if not n in planted and found[n] is not None)
+	print("Near-duplicates missed: {}, unrelated matched: {}".format(missed, spurious))
+	return missed
+
+def compare_images(paths):
+	import media_util
+	
+	hashes = []
+	for path in paths:
+		with open(path, "rb") as file:
+			hashes.append(media_util.hash_image(file.read()))
+		print("{:016x}  {}".format(hashes[-1], path))
+	
+	print()
+	for i, a in enumerate(paths):
+		for j in range(i + 1, len(paths)):
+			print("{:>2} bits  {} / {}".format(bin(hashes[i] ^ hashes[j]).count("1"), a, paths[j]))
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description="Image hash index benchmark")
+	parser.add_argument("--size", type=int, default=300000, help="number of hashes in the index")
+	parser.add_argument("--queries", type=int, default=200, help="number of hashes searched in one batch")
+	parser.add_argument("images", nargs="*", help="image files to hash and compare")
+	args = parser.parse_args()
+	
+	missed = benchmark(args.size, args.queries)
+	if len(args.images) > 0:
+		print()
+		compare_images(args.images)
+	sys.exit(1 if missed > 0 else 0)
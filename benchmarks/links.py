@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Benchmarks text_util.extract_links against the regex it replaced on
+pathological comment bodies, and fuzzes both to check they extract the
+same links.
+
+Usage: benchmarks/links.py [--size BYTES] [--fuzz COUNT]
+"""
+
+import os, sys, re, random
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from text_util import extract_links
+
+_regex = re.compile("((?:[a-z]+://)?(?:[a-z0-9]+\.)+[a-z]{2,}(?:[^)\]}\* \t\r\n]*)?)", flags=re.IGNORECASE)
+
+def regex_links(text):
+	return _regex.findall(text)
+
+# Corpus
+
+def pathological_bodies(size):
+	return [
+		("letters", "a" * size),
+		("digits", "1" * size),
+		("dotted letters", "a." * (size // 2)),
+		("dotted digits", "1." * (size // 2)),
+		("double dots", "aa.." * (size // 4)),
+		("no tld", ("a" * 50 + ".1") * (size // 52)),
+		("fake schemes", "http:/" * (size // 6)),
+		("scheme runs", ("a" * 30 + "://") * (size // 33)),
+		("many links", "see example.com/path and " * (size // 25)),
+		("normal comment", "I think this is a great video, check out https://youtu.be/dQw4w9WgXcQ for more. " * (size // 80))
+	]
+
+def fuzz_bodies(count, seed=1):
+	rand = random.Random(seed)
+	alphabet = "aZk09.:/-_?=&)]}*\t\n Kİ"
+	pieces = ["http://", "https://", "www.", ".com", ".co.uk", "youtu.be/", "..", "://"]
+	for n in range(count):
+		parts = []
+		for m in range(rand.randint(0, 12)):
+			if rand.random() < 0.3:
+				parts.append(rand.choice(pieces))
+			else:
+				parts.append("".join(rand.choice(alphabet) for c in range(rand.randint(1, 6))))
+		yield "".join(parts)
+
+# Running
+
+def benchmark(size):
+	print("Body size: {} bytes".format(size))
+	print("{:<16} {:>12} {:>12}".format("", "regex (ms)", "scanner (ms)"))
+	for name, body in pathological_bodies(size):
+		start = timer()
+		expected = regex_links(body)
+		regex_time = timer() - start
+		
+		start = timer()
+		found = extract_links(body)
+		scanner_time = timer() - start
+		
+		mismatch = "" if found == expected else "  MISMATCH"
+		print("{:<16} {:>12.2f} {:>12.2f}{}".format(name, regex_time * 1000, scanner_time * 1000, mismatch))
+
+def fuzz(count):
+	failures = 0
+	for body in fuzz_bodies(count):
+		expected = regex_links(body)
+		found = extract_links(body)
+		if found != expected:
+			failures += 1
+			if failures <= 10:
+				print("Mismatch on {!r}: regex {}, scanner {}".format(body, expected, found))
+	print("Fuzzed {} bodies, {} mismatches".format(count, failures))
+	return failures
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description="Link extraction benchmark and fuzzer")
+	parser.add_argument("--size", type=int, default=10000, help="size of each pathological body")
+	parser.add_argument("--fuzz", type=int, default=100000, help="number of random bodies to compare")
+	args = parser.parse_args()
+	
+	benchmark(args.size)
+	print()
+	sys.exit(1 if fuzz(args.fuzz) > 0 else 0)
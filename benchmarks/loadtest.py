@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test. Runs the bot against local stand-ins for reddit (OAuth,
+listings, wiki, and moderation actions) and the YouTube Data API, feeds the
+fake subreddit synthetic posts and comments at a chosen rate, and reports how
+quickly spam was removed and how many API calls it took.
+
+Both stand-ins can add latency, fail a share of requests, and enforce a rate
+limit, so changes to polling, caching, and request budgeting can be compared
+under the same load.
+
+Usage: benchmarks/loadtest.py [--rate PER_SECOND] [--duration SECONDS] [--spam SHARE] ...
+"""
+
+from abc import ABCMeta, abstractmethod
+import os, sys, json, random, string, tempfile, threading
+from collections import Counter
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+from time import time, sleep
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_spam_phrases = ["cheap followers", "free gift card"]
+_spam_channel = "UCloadtestspam"
+_wiki_config = """filter: phrases
+action: remove
+phrases: {phrases}
+reason: Spam phrase
+---
+filter: youtube-channel
+action: ban
+ids: ["{channel}"]
+""".format(phrases=json.dumps(_spam_phrases), channel=_spam_channel)
+
+# Stand-in servers
+
+class _Server(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+class _Handler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	
+	def do_GET(self):
+		self._handle("GET", {})
+	
+	def do_POST(self):
+		length = int(self.headers.get("Content-Length", 0))
+		form = parse_qs(self.rfile.read(length).decode("utf-8"))
+		self._handle("POST", {k: v[0] for k, v in form.items()})
+	
+	def _handle(self, method, form):
+		url = urlsplit(self.path)
+		query = {k: v[0] for k, v in parse_qs(url.query).items()}
+		status, headers, body = self.server.fake.respond(method, url.path, query, form, self.headers)
+		
+		body = json.dumps(body).encode("utf-8") if body is not None else b""
+		self.send_response(status)
+		for key, value in headers.items():
+			self.send_header(key, value)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+	
+	def log_message(self, format, *args):
+		pass
+
+class FakeService(metaclass=ABCMeta):
+	"""
+	Base for the stand-ins: counts calls, adds latency, and fails the given
+	share of requests.
+	"""
+	
+	def __init__(self, latency=0, error_rate=0, seed=1):
+		self.latency = latency
+		self.error_rate = error_rate
+		self.calls = Counter()
+		self.errors = 0
+		self.lock = threading.Lock()
+		self._random = random.Random(seed)
+		self._server = None
+	
+	def start(self):
+		self._server = _Server(("127.0.0.1", 0), _Handler)
+		self._server.fake = self
+		threading.Thread(target=self._server.serve_forever, daemon=True).start()
+		return "http://127.0.0.1:{}".format(self._server.server_address[1])
+	
+	def stop(self):
+		if self._server is not None:
+			self._server.shutdown()
+	
+	def respond(self, method, path, query, form, headers):
+		if self.latency > 0:
+			sleep(self._random.expovariate(1 / self.latency))
+		with self.lock:
+			self.calls[self.endpoint(path)] += 1
+			if self._random.random() < self.error_rate:
+				self.errors += 1
+				return 503, {}, {"error": 503}
+			return self.handle(method, path, query, form, headers)
+	
+	def endpoint(self, path):
+		return path
+	
+	@abstractmethod
+	def handle(self, method, path, query, form, headers):
+		"""
+		Returns (status, headers, JSON body) for a request.
+		"""
+		pass
+
+class FakeReddit(FakeService):
+	"""
+	A single subreddit with a moderator account. Keeps the creation and
+	removal time of every thing so time-to-removal can be measured.
+	"""
+	
+	def __init__(self, subreddit, rate_limit=600, window=600, **kwargs):
+		super().__init__(**kwargs)
+		self.subreddit = subreddit
+		self.rate_limit = rate_limit
+		self.window = window
+		self.throttled = 0
+		
+		self.things = {}
+		self.listings = {"new": [], "comments": []}
+		self.positions = {}
+		self.created = {}
+		self.removed = {}
+		self.spam = set()
+		self.polls = Counter()
+		
+		self._next_id = 1000
+		self._window_start = time()
+		self._used = 0
+	
+	def endpoint(self, path):
+		parts = path.strip("/").split("/")
+		if len(parts) >= 3 and parts[0] == "r":
+			return "/r/*/"+"/".join(parts[2:3])
+		return path
+	
+	# Content
+	
+	def _new_id(self):
+		self._next_id += 1
+		n, digits = self._next_id, []
+		while n > 0:
+			n, d = divmod(n, 36)
+			digits.append((string.digits + string.ascii_lowercase)[d])
+		return "".join(reversed(digits))
+	
+	def add_post(self, author, title, selftext=None, url=None, spam=False):
+		with self.lock:
+			post_id = self._new_id()
+			permalink = "/r/{}/comments/{}/_/".format(self.subreddit, post_id)
+			data = {
+				"id": post_id, "name": "t3_"+post_id, "author": author, "subreddit": self.subreddit,
+				"created_utc": time(), "permalink": permalink, "title": title,
+				"is_self": url is None, "url": url or "https://www.reddit.com"+permalink,
+				"selftext": selftext or "", "selftext_html": None, "banned_by": None, "approved_by": None
+			}
+			return self._add("new", "t3", data, spam)
+	
+	def add_comment(self, author, body, spam=False):
+		with self.lock:
+			posts = self.listings["new"]
+			link_id = posts[self._random.randrange(len(posts))] if len(posts) > 0 else "t3_0"
+			comment_id = self._new_id()
+			data = {
+				"id": comment_id, "name": "t1_"+comment_id, "author": author, "subreddit": self.subreddit,
+				"created_utc": time(), "body": body, "link_id": link_id, "banned_by": None, "approved_by": None
+			}
+			return self._add("comments", "t1", data, spam)
+	
+	def _add(self, listing, kind, data, spam):
+		fullname = data["name"]
+		self.things[fullname] = {"kind": kind, "data": data}
+		self.positions[fullname] = len(self.listings[listing])
+		self.listings[listing].append(fullname)
+		self.created[fullname] = timer()
+		if spam:
+			self.spam.add(fullname)
+		return fullname
+	
+	# Requests
+	
+	def _rate_headers(self):
+		now = time()
+		if now - self._window_start >= self.window:
+			self._window_start = now
+			self._used = 0
+		self._used += 1
+		return {
+			"x-ratelimit-used": str(self._used),
+			"x-ratelimit-remaining": str(max(self.rate_limit - self._used, 0)),
+			"x-ratelimit-reset": str(int(self.window - (now - self._window_start)))
+		}
+	
+	def handle(self, method, path, query, form, headers):
+		if path == "/api/v1/access_token":
+			return 200, {}, {"access_token": "loadtest", "token_type": "bearer", "expires_in": 3600, "scope": "*"}
+		
+		rate_headers = self._rate_headers()
+		if self._used > self.rate_limit:
+			self.throttled += 1
+			return 429, rate_headers, {"error": 429}
+		
+		sub = "/r/"+self.subreddit
+		if path == "/api/v1/me":
+			body = {"name": "loadtest-bot", "id": "1"}
+		elif path in (sub+"/new", sub+"/comments"):
+			body = self._listing(path.rsplit("/", 1)[1], query)
+		elif path == "/api/info":
+			children = [self.things[f] for f in query.get("id", "").split(",") if f in self.things]
+			body = {"kind": "Listing", "data": {"children": children, "after": None}}
+		elif path == sub+"/about/moderators":
+			body = {"kind": "UserList", "data": {"children": [{"name": "loadtest-bot", "id": "t2_1", "date": 0, "mod_permissions": ["all"]}]}}
+		elif path.startswith(sub+"/wiki/revisions/"):
+			body = {"kind": "Listing", "data": {"children": [{"id": "rev1", "timestamp": 0}], "after": None}}
+		elif path.startswith(sub+"/wiki/"):
+			if headers.get("If-None-Match") == '"rev1"':
+				return 304, dict(rate_headers, ETag='"rev1"'), None
+			rate_headers["ETag"] = '"rev1"'
+			body = {"kind": "wikipage", "data": {"content_md": _wiki_config, "revision_id": "rev1"}}
+		elif path == "/api/remove":
+			fullname = form.get("id")
+			if fullname in self.things and not fullname in self.removed:
+				self.removed[fullname] = timer()
+				self.things[fullname]["data"]["banned_by"] = "loadtest-bot"
+			body = {}
+		elif path == "/api/comment":
+			body = {"json": {"errors": [], "data": {"things": [{"kind": "t1", "data": {"name": "t1_reply"}}]}}}
+		elif method == "POST":
+			body = {"json": {"errors": [], "data": {}}}
+		else:
+			body = {"kind": "Listing", "data": {"children": [], "after": None}}
+		return 200, rate_headers, body
+	
+	def _listing(self, name, query):
+		if query.get("after") is None:
+			self.polls[name] += 1
+		
+		fullnames = self.listings[name]
+		end = self.positions.get(query.get("after"), len(fullnames))
+		limit = min(int(query.get("limit", 25)), 100)
+		page = fullnames[max(end - limit, 0):end][::-1]
+		after = page[-1] if len(page) == limit else None
+		return {"kind": "Listing", "data": {"children": [self.things[f] for f in page], "after": after}}
+
+class FakeYouTube(FakeService):
+	"""
+	Answers video, playlist, and comment thread lookups. Video IDs starting
+	with "S" belong to the banned channel. Requests past the daily quota fail
+	like the real API does.
+	"""
+	
+	def __init__(self, quota=10000, **kwargs):
+		super().__init__(**kwargs)
+		self.quota = quota
+		self.throttled = 0
+	
+	def handle(self, method, path, query, form, headers):
+		if sum(self.calls.values()) > self.quota:
+			self.throttled += 1
+			return 403, {}, {"error": {"errors": [{"reason": "quotaExceeded"}]}}
+		
+		item_id = query.get("id") or query.get("videoId") or ""
+		channel = _spam_channel if item_id.startswith("S") else "UCloadtest"+item_id[1:3]
+		etag = '"{}"'.format(item_id)
+		if headers.get("If-None-Match") == etag:
+			return 304, {"ETag": etag}, None
+		
+		items = []
+		if path.endswith("/videos") or path.endswith("/playlists"):
+			kind = "youtube#video" if path.endswith("/videos") else "youtube#playlist"
+			items.append({
+				"kind": kind, "id": item_id,
+				"snippet": {"channelId": channel, "channelTitle": channel, "description": ""},
+				"contentDetails": {"duration": "PT3M20S"}
+			})
+		return 200, {"ETag": etag}, {"kind": "youtube#listResponse", "items": items}
+
+# Traffic
+
+def _video_id(rand, spam):
+	return ("S" if spam else "V") + "".join(rand.choice(string.ascii_letters + string.digits) for n in range(10))
+
+def generate_traffic(reddit, rate, duration, spam_share, post_share, seed=1):
+	"""
+	Adds things to the fake subreddit as a Poisson process until the duration
+	is up. Spam is either a spam phrase or a video from the banned channel.
+	"""
+	rand = random.Random(seed)
+	end = timer() + duration
+	count = 0
+	while timer() < end:
+		sleep(rand.expovariate(rate))
+		spam = rand.random() < spam_share
+		author = "user{}".format(rand.randrange(500))
+		phrase = rand.choice(_spam_phrases) if spam else "a perfectly normal sentence"
+		
+		if rand.random() < post_share:
+			if rand.random() < 0.5:
+				video = "https://www.youtube.com/watch?v="+_video_id(rand, spam)
+				reddit.add_post(author, "Check out this video", url=video, spam=spam)
+			else:
+				reddit.add_post(author, "Discussion thread", selftext="Here's {} for you".format(phrase), spam=spam)
+		else:
+			reddit.add_comment(author, "I think this is {}".format(phrase), spam=spam)
+		count += 1
+	return count
+
+# Running
+
+def configure(args, reddit_url, youtube_url, work_dir):
+	import config
+	
+	config.username = config.password = "loadtest-bot"
+	config.oauth_id = config.oauth_secret = "loadtest"
+	config.subreddit = config.config_subreddit = "loadtest"
+	config.log_subreddit = None
+	config.reddit_auth_url = reddit_url+"/api/v1/access_token"
+	config.reddit_oauth_url = reddit_url
+	config.reddit_request_delay = 0
+	config.youtube_api_url = youtube_url+"/youtube/v3/"
+	config.youtube_api_key = "loadtest"
+	
+	config.enabled_filters = ["phrases", "youtube-channel"]
+	config.cache_location = work_dir
+	config.cache_backend = "pickle"
+	config.snapshot_file = os.path.join(work_dir, "snapshot.cache")
+	config.backfill_max_age = 0
+	config.poll_posts = config.poll_comments = (args.poll_min, args.poll_max)
+	config.worker_processes = args.workers
+
+def percentile(values, p):
+	if len(values) == 0:
+		return float("nan")
+	return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+def report(reddit, youtube, items, elapsed):
+	removal_times = sorted(reddit.removed[f] - reddit.created[f] for f in reddit.spam if f in reddit.removed)
+	missed = len(reddit.spam) - len(removal_times)
+	false_removals = len([f for f in reddit.removed if not f in reddit.spam])
+	reddit_calls = sum(reddit.calls.values())
+	youtube_calls = sum(youtube.calls.values())
+	minutes = elapsed / 60
+	
+	print("Items: {} ({} spam), run time {:.0f}s".format(items, len(reddit.spam), elapsed))
+	print("Time to removal (s): p50 {:.2f}, p90 {:.2f}, p99 {:.2f}, max {:.2f}".format(
+		percentile(removal_times, 50), percentile(removal_times, 90), percentile(removal_times, 99),
+		removal_times[-1] if len(removal_times) > 0 else float("nan")))
+	print("Spam missed: {}, false removals: {}".format(missed, false_removals))
+	print("API calls per item: reddit {:.2f}, YouTube {:.2f}".format(reddit_calls / max(items, 1), youtube_calls / max(items, 1)))
+	print("Passes per minute: posts {:.1f}, comments {:.1f}".format(reddit.polls["new"] / minutes, reddit.polls["comments"] / minutes))
+	print("Errors injected: reddit {}, YouTube {}; throttled: reddit {}, YouTube {}".format(
+		reddit.errors, youtube.errors, reddit.throttled, youtube.throttled))
+	print()
+	print("Reddit calls by endpoint:")
+	for endpoint, count in reddit.calls.most_common():
+		print("  {:<32} {:>6}".format(endpoint, count))
+	return missed
+
+def run(args):
+	import argparse, logging, log_util
+	
+	reddit = FakeReddit("loadtest", rate_limit=args.rate_limit, latency=args.latency, error_rate=args.error_rate)
+	youtube = FakeYouTube(quota=args.youtube_quota, latency=args.latency, error_rate=args.error_rate)
+	reddit_url = reddit.start()
+	youtube_url = youtube.start()
+	
+	work_dir = tempfile.mkdtemp(prefix="spamshark-loadtest-")
+	configure(args, reddit_url, youtube_url, work_dir)
+	log_util.init_logging(None, level=logging.DEBUG if args.verbose else logging.WARNING)
+	
+	import spam_shark
+	spam_shark.args = argparse.Namespace(no_input=True, no_update=False, once=False)
+	spam_shark.build_local_config()
+	bot = threading.Thread(target=spam_shark.process_loop, name="SpamShark-loadtest")
+	
+	start = timer()
+	bot.start()
+	try:
+		items = generate_traffic(reddit, args.rate, args.duration, args.spam, args.posts)
+		sleep(args.drain)
+	finally:
+		spam_shark.running = False
+		spam_shark.waitEvent.set()
+		bot.join()
+		elapsed = timer() - start
+		reddit.stop()
+		youtube.stop()
+		log_util.stop_logging()
+	
+	print("Work directory: {}".format(work_dir))
+	return report(reddit, youtube, items, elapsed)
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description="End-to-end load test against local reddit and YouTube stand-ins")
+	parser.add_argument("--rate", type=float, default=2, help="things submitted per second")
+	parser.add_argument("--duration", type=float, default=60, help="seconds of traffic")
+	parser.add_argument("--drain", type=float, default=30, help="seconds to keep running after traffic stops")
+	parser.add_argument("--spam", type=float, default=0.1, help="share of things that are spam")
+	parser.add_argument("--posts", type=float, default=0.3, help="share of things that are posts rather than comments")
+	parser.add_argument("--latency", type=float, default=0.05, help="mean seconds added to each stand-in response")
+	parser.add_argument("--error-rate", type=float, default=0, help="share of stand-in requests that fail with a 503")
+	parser.add_argument("--rate-limit", type=int, default=600, help="reddit requests allowed per 10 minutes")
+	parser.add_argument("--youtube-quota", type=int, default=10000, help="YouTube requests allowed for the whole run")
+	parser.add_argument("--poll-min", type=float, default=2, help="minimum seconds between listing polls")
+	parser.add_argument("--poll-max", type=float, default=30, help="maximum seconds between listing polls")
+	parser.add_argument("--workers", type=int, default=0, help="filter worker processes")
+	parser.add_argument("-v", "--verbose", action="store_true", help="show the bot's debug logging")
+	args = parser.parse_args()
+	
+	sys.exit(1 if run(args) > 0 else 0)
@@ -1,19 +1,54 @@
 from collections import deque, Iterable, OrderedDict
 from abc import ABCMeta, abstractmethod
 from time import time
-import bz2, pickle, os, sys
+from threading import local
+from logging import info, warning
+import bz2, pickle, os, sys, socket, sqlite3
 
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
-def load_cached_storage(cache_file, default_size=1000):
+# Backend selection
+
+_shared_store = None
+
+def open_thing_cache(name, cache_size=1000):
+	"""
+	Returns the cache of processed thing IDs with the given name, shared with
+	other instances on this host if the sqlite backend is configured.
+	"""
+	import config
+	if config.cache_backend == "sqlite":
+		return SharedThingCache(_get_shared_store(), name)
+	return load_cached_storage(config.cache_location+"/"+name+".cache", default_size=cache_size)
+
+def open_obj_cache(name, expiration):
+	"""
+	Returns a cache of objects expiring after the given number of seconds,
+	shared with other instances on this host if the sqlite backend is configured.
+	"""
+	import config
+	if config.cache_backend == "sqlite":
+		return SharedObjCache(_get_shared_store(), name, expiration)
+	return TimedObjCache(expiration=expiration)
+
+def _get_shared_store():
+	global _shared_store
+	if _shared_store is None:
+		import config
+		_shared_store = SQLiteStore(config.shared_cache_file)
+	return _shared_store
+
+def load_cached_storage(cache_file, default_size=1000, factory=None):
 	if cache_file is not None and os.path.exists(cache_file):
-		print("Loading cache: {0}".format(cache_file))
-		with bz2.open(cache_file, "rb") as file:
-			try:
-				cache = pickle.load(file)
-				return cache
-			except pickle.PickleError and EOFError:
-				return None
+		info("Loading cache: {0}".format(cache_file))
+		try:
+			with bz2.open(cache_file, "rb") as file:
+				return pickle.load(file)
+		except (pickle.PickleError, EOFError, OSError, AttributeError, ImportError) as e:
+			# Start over rather than failing to start
+			warning("Failed to load cache {0}, starting empty ({1})".format(cache_file, e))
+	if factory is not None:
+		return factory()
 	return ThingCache(cache_size=default_size, file=cache_file)
 
 class Cache(Iterable, metaclass=ABCMeta):
@@ -44,15 +79,15 @@ class TimedObjCache(Cache):
 		self.expiration = expiration
 	
 	def _prune(self):
+		# Entries are kept in the order they were stored, oldest first
 		old = []
-		for key in self._data.keys():
-			data, added = self._data[key]
-			time_since = time() - added
-			if time_since >= self.expiration:
-				old.append((key, data))
-				del self._data[key]
-			else:
+		now = time()
+		while len(self._data) > 0:
+			key, (data, added) = next(iter(self._data.items()))
+			if now - added < self.expiration:
 				break
+			self._data.popitem(last=False)
+			old.append((key, data))
 		return old
 	
 	def get(self, key):
@@ -64,12 +99,13 @@ class TimedObjCache(Cache):
 	
 	def store(self, key, data):
 		self._data[key] = (data, time())
+		self._data.move_to_end(key)
 	
 	def data(self):
 		return self._data
 	
 	def __iter__(self):
-		self._data.__iter__()
+		return self._data.__iter__()
 
 class ThingCache(Cache):
 	def __init__(self, cache_size=1000, file=None):
@@ -115,3 +151,321 @@ class ThingCache(Cache):
 	def __iter__(self):
 		return self._post_ids.__iter__()
 	
+
+class MinHashIndex(Cache):
+	"""
+	Locality-sensitive hashing index of MinHash signatures. Signatures are split
+	into bands and only items sharing a band are compared, so lookups don't scan
+	the whole index. Items expire after a while and the index never holds more
+	than max_items.
+	"""
+	
+	def __init__(self, bands=16, rows=4, expiration=21600, max_items=50000, file=None):
+		super().__init__(file)
+		
+		self.bands = bands
+		self.rows = rows
+		self.expiration = expiration
+		self.max_items = max_items
+		
+		self._items = OrderedDict()
+		self._buckets = {}
+	
+	def _band_keys(self, signature):
+		rows = self.rows
+		return [(band, hash(signature[band*rows:(band+1)*rows])) for band in range(self.bands)]
+	
+	def _prune(self):
+		now = time()
+		while len(self._items) > 0:
+			item_id, (signature, added, meta) = next(iter(self._items.items()))
+			if now - added < self.expiration and len(self._items) <= self.max_items:
+				break
+			del self._items[item_id]
+			for key in self._band_keys(signature):
+				bucket = self._buckets.get(key)
+				if bucket is not None:
+					bucket.discard(item_id)
+					if len(bucket) == 0:
+						del self._buckets[key]
+	
+	def add(self, item_id, signature, meta=None):
+		if item_id in self._items:
+			return
+		self._items[item_id] = (signature, time(), meta)
+		for key in self._band_keys(signature):
+			self._buckets.setdefault(key, set()).add(item_id)
+		self._prune()
+	
+	def candidates(self, signature):
+		"""
+		Returns (item_id, signature, meta) for every item sharing at least one
+		band with the signature.
+		"""
+		self._prune()
+		
+		found = set()
+		for key in self._band_keys(signature):
+			found.update(self._buckets.get(key, ()))
+		return [(item_id, self._items[item_id][0], self._items[item_id][2]) for item_id in found]
+	
+	def data(self):
+		return self._items
+	
+	def __iter__(self):
+		return self._items.__iter__()
+	
+	def __len__(self):
+		return len(self._items)
+
+_swar_masks = None
+
+def _popcount(values):
+	"""
+	Number of set bits in each element of a uint64 array, which is modified.
+	"""
+	import numpy as np
+	global _swar_masks
+	
+	if hasattr(np, "bitwise_count"):
+		return np.bitwise_count(values)
+	
+	# Parallel bit counting for NumPy before 2.0
+	if _swar_masks is None:
+		_swar_masks = [np.uint64(m) for m in (0x5555555555555555, 0x3333333333333333, 0x0f0f0f0f0f0f0f0f, 0x0101010101010101, 1, 2, 4, 56)]
+	m1, m2, m4, h01, s1, s2, s4, s56 = _swar_masks
+	values -= (values >> s1) & m1
+	values = (values & m2) + ((values >> s2) & m2)
+	values += values >> s4
+	values &= m4
+	values *= h01
+	values >>= s56
+	return values
+
+class ImageHashIndex(Cache):
+	"""
+	64-bit perceptual image hashes with a name and time each, held in NumPy
+	arrays and searched by Hamming distance. A batch of queries is compared
+	against the whole index in a few vectorized operations, and the index is
+	saved as a .npz file rather than pickled. Items expire after a while if
+	an expiration is given.
+	NumPy is imported on first use so the bot can run without it.
+	"""
+	
+	def __init__(self, file=None, expiration=None, capacity=1024):
+		super().__init__(file)
+		import numpy as np
+		
+		self.expiration = expiration
+		self._hashes = np.zeros(capacity, dtype=np.uint64)
+		self._times = np.zeros(capacity, dtype=np.float64)
+		self._names = []
+		
+		if file is not None and os.path.exists(file):
+			self._load(file)
+	
+	def _load(self, file):
+		import numpy as np
+		
+		try:
+			with np.load(file, allow_pickle=False) as saved:
+				hashes, times, names = saved["hashes"], saved["times"], saved["names"].tolist()
+		except (OSError, ValueError, KeyError) as e:
+			warning("Failed to load image index {0}, starting empty ({1})".format(file, e))
+			return
+		self._names = []
+		self.add(hashes, names, times)
+		info("Loaded {} image hashes from {}".format(len(self), file))
+	
+	def add(self, hashes, names, times=None):
+		import numpy as np
+		
+		count = len(names)
+		size = len(self._names)
+		if size + count > len(self._hashes):
+			capacity = max(2 * len(self._hashes), size + count)
+			self._hashes = np.resize(self._hashes, capacity)
+			self._times = np.resize(self._times, capacity)
+		
+		self._hashes[size:size+count] = np.asarray(hashes, dtype=np.uint64)
+		self._times[size:size+count] = time() if times is None else times
+		self._names.extend(names)
+	
+	def search(self, hashes, max_distance):
+		"""
+		Finds the closest item to each query hash. Returns a list with a
+		(name, distance) tuple for each query, or None where nothing is within
+		max_distance bits.
+		"""
+		import numpy as np
+		
+		self._prune()
+		queries = np.asarray(hashes, dtype=np.uint64)
+		size = len(self._names)
+		if size == 0 or len(queries) == 0:
+			return [None] * len(queries)
+		
+		# Bound the size of the (queries, items) distance matrix
+		found = []
+		indexed = self._hashes[:size]
+		chunk = max(1, 4000000 // size)
+		for start in range(0, len(queries), chunk):
+			distances = _popcount(np.bitwise_xor(queries[start:start+chunk, None], indexed[None, :]))
+			best = distances.argmin(axis=1)
+			for row, column in enumerate(best):
+				distance = int(distances[row, column])
+				found.append((self._names[column], distance) if distance <= max_distance else None)
+		return found
+	
+	def _prune(self):
+		if self.expiration is None or len(self._names) == 0:
+			return
+		import numpy as np
+		
+		size = len(self._names)
+		keep = self._times[:size] >= time() - self.expiration
+		if keep.all():
+			return
+		kept = np.flatnonzero(keep)
+		self._hashes[:len(kept)] = self._hashes[kept]
+		self._times[:len(kept)] = self._times[kept]
+		self._names = [self._names[i] for i in kept]
+	
+	def save(self):
+		if self.cache_file is None:
+			return
+		import numpy as np
+		
+		size = len(self._names)
+		temp_file = self.cache_file+".tmp"
+		with open(temp_file, "wb") as file:
+			np.savez(file, hashes=self._hashes[:size], times=self._times[:size], names=np.array(self._names, dtype=str))
+		os.replace(temp_file, self.cache_file)
+	
+	def data(self):
+		return self._names
+	
+	def __iter__(self):
+		return self._names.__iter__()
+	
+	def __len__(self):
+		return len(self._names)
+
+# Shared backend
+
+class SQLiteStore:
+	"""
+	SQLite database in WAL mode, safe to share between processes on one host.
+	Each thread gets its own connection.
+	"""
+	
+	def __init__(self, path):
+		self.path = path
+		self.owner = "{}:{}".format(socket.gethostname(), os.getpid())
+		self._local = local()
+		
+		directory = os.path.dirname(path)
+		if len(directory) > 0:
+			os.makedirs(directory, exist_ok=True)
+	
+	def connection(self):
+		conn = getattr(self._local, "conn", None)
+		if conn is None:
+			conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+			conn.execute("PRAGMA journal_mode=WAL")
+			conn.execute("PRAGMA synchronous=NORMAL")
+			conn.execute("CREATE TABLE IF NOT EXISTS claims (thing_id TEXT PRIMARY KEY, owner TEXT, claimed_at REAL)")
+			conn.execute("CREATE TABLE IF NOT EXISTS objects (namespace TEXT, key TEXT, value BLOB, stored_at REAL, PRIMARY KEY (namespace, key))")
+			self._local.conn = conn
+		return conn
+
+class SharedThingCache(Cache):
+	"""
+	ThingCache backed by the shared store. Thing IDs are claimed atomically, so
+	each thing is only returned as new to one instance.
+	"""
+	
+	def __init__(self, store, name, retention=604800):
+		super().__init__(None)
+		
+		self.db = store
+		self.name = name
+		self.retention = retention
+		self._last_prune = 0
+	
+	def get_diff(self, posts):
+		conn = self.db.connection()
+		now = time()
+		
+		new_posts = []
+		conn.execute("BEGIN IMMEDIATE")
+		try:
+			for post in posts:
+				cursor = conn.execute("INSERT OR IGNORE INTO claims VALUES (?, ?, ?)",
+									  (self.name+":"+post.id, self.db.owner, now))
+				if cursor.rowcount == 1:
+					new_posts.append(post)
+			
+			# Forget claims old enough to have dropped off every listing
+			if now - self._last_prune >= 3600:
+				conn.execute("DELETE FROM claims WHERE claimed_at < ?", (now - self.retention,))
+				self._last_prune = now
+			conn.execute("COMMIT")
+		except:
+			conn.execute("ROLLBACK")
+			raise
+		
+		return new_posts
+	
+	def save(self):
+		pass
+	
+	def data(self):
+		return [row[0] for row in self.db.connection().execute(
+			"SELECT thing_id FROM claims WHERE thing_id LIKE ?", (self.name+":%",))]
+	
+	def __iter__(self):
+		return self.data().__iter__()
+
+class SharedObjCache(Cache):
+	"""
+	TimedObjCache backed by the shared store.
+	"""
+	
+	def __init__(self, store, namespace, expiration=3600):
+		super().__init__(None)
+		
+		self.db = store
+		self.namespace = namespace
+		self.expiration = expiration
+		self._last_prune = 0
+	
+	def _prune(self):
+		now = time()
+		if now - self._last_prune >= self.expiration:
+			self.db.connection().execute("DELETE FROM objects WHERE namespace = ? AND stored_at < ?",
+											(self.namespace, now - self.expiration))
+			self._last_prune = now
+	
+	def get(self, key):
+		self._prune()
+		
+		row = self.db.connection().execute("SELECT value, stored_at FROM objects WHERE namespace = ? AND key = ?",
+											  (self.namespace, key)).fetchone()
+		if row is None or time() - row[1] >= self.expiration:
+			return None
+		return pickle.loads(row[0])
+	
+	def store(self, key, data):
+		self.db.connection().execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)",
+										(self.namespace, key, pickle.dumps(data), time()))
+	
+	def save(self):
+		pass
+	
+	def data(self):
+		return dict((row[0], pickle.loads(row[1])) for row in self.db.connection().execute(
+			"SELECT key, value FROM objects WHERE namespace = ?", (self.namespace,)))
+	
+	def __iter__(self):
+		return self.data().__iter__()
@@ -4,21 +4,46 @@ username			= ""
 password			= ""
 oauth_id			= ""					# Create a "script" application here: https://www.reddit.com/prefs/apps/
 oauth_secret		= ""
+reddit_auth_url		= "https://www.reddit.com/api/v1/access_token"
+reddit_oauth_url	= None					# Base URL of the OAuth API (None for praw's default, only changed for load testing)
+reddit_request_delay	= 1					# Minimum seconds between reddit requests
+action_max_wait			= 5					# Seconds a moderation action may wait for the rate limit to reset before it's retried later
 
 # Subreddit
 subreddit			= ""
-submitter_blacklist	= ["AutoModerator"]
+submitter_blacklist	= ["AutoModerator"]		# Users whose posts and comments are never filtered
+trusted_users		= []					# More users whose posts and comments are never filtered (moderators are always skipped)
+moderator_cache_time	= 3600				# Seconds the moderator list is cached for
 
 config_subreddit	= subreddit
 config_page			= "spamshark"
 config_whitelist	= []					# Whitelist of users able to trigger a config update (leave empty for no whitelist)
+config_poll_interval	= 300					# Seconds between checks for a new wiki config revision
 
 log_subreddit		= None					# Subreddit to which log messages are sent (leave None for no logging)
 
 # Bot
 cache_location		= "cache"
+cache_backend		= "pickle"				# "pickle" for per-instance caches, "sqlite" to share caches with other instances on this host
+shared_cache_file	= "cache/shared.db"		# SQLite database used by the "sqlite" cache backend
+snapshot_file		= "cache/snapshot.cache"	# Warm state kept between --once runs
 filter_location		= "filters"				# Relative directory containing filter files
 enabled_filters		= ["youtube-channel", "youtube-votemanip"]
+filter_time_budget	= 10					# Seconds a filter may spend on a single thing
+filter_update_budget	= 60					# Seconds a filter may spend in its update step
+filter_max_failures	= 3						# Consecutive timeouts/errors before a filter is bypassed
+filter_cooldown		= 300					# Seconds a bypassed filter waits before being probed again
+filter_order		= []					# Filter IDs always run first, in this order (the rest are ordered by measured cost and removal rate)
+poll_posts			= (10, 120)				# Min and max seconds between checks for new posts
+poll_comments		= (10, 120)				# Min and max seconds between checks for new comments
+poll_inbox			= (20, 300)				# Min and max seconds between inbox checks
+backfill_max_age	= 86400					# After downtime, go back at most this many seconds to moderate missed things (0 to disable)
+backfill_pages		= 2						# Listing pages of missed things to moderate per pass
+log_file			= "spamshark.log"		# Log file used with --no-input, written as JSON lines
+log_max_bytes		= 10485760				# Size at which the log file is rotated
+log_backups			= 5						# Number of rotated log files to keep
+worker_processes	= 0						# Processes evaluating filters in parallel, sharded by author (0 to evaluate in the main thread)
 
 # Filters
+youtube_api_url		= "https://www.googleapis.com/youtube/v3/"
 youtube_api_key		= ""					# Create an API key by following these instructions: https://developers.google.com/youtube/registering_an_application
@@ -0,0 +1,22 @@
+from registry import register
+
+# Filter manifest
+# Lets the bot know about filters without importing them. Modules not listed
+# here are still discovered by importing and scanning them, which is slower.
+
+register("youtube-channel", "defaults", "YouTubeChannelFilter", types=("link",),
+		name="YouTube Channel Bans and Monitors", author="Enigma")
+register("youtube-votemanip", "defaults", "YouTubeVoteManipFilter", types=("post",),
+		name="YouTube Vote Manipulation Monitoring", author="Enigma")
+register("youtube-duration", "defaults", "YouTubeDurationFilter", types=("post",),
+		name="YouTube Video Duration Filter", author="Enigma")
+register("sub-blacklist", "sub_contributor_blacklist", "SubContributorBlacklist", types=("post", "comment"),
+		name="Subreddit Contributor Blacklist", descr="Removes submissions from contributors to blacklisted subreddits", author="Enigma")
+register("phrases", "phrases", "PhraseFilter", types=("post", "comment"),
+		name="Phrase and Regex Matching", descr="Matches titles and bodies against large phrase and regex lists", author="Enigma")
+register("copypasta", "copypasta", "CopypastaFilter", types=("post", "comment"),
+		name="Near-Duplicate Copypasta Detection", descr="Catches the same text posted with small variations across many things", author="Enigma")
+register("bursts", "bursts", "BurstFilter", types=("post", "comment"),
+		name="Author and Domain Burst Detection", descr="Acts on authors or domains posting many things in a short time", author="Enigma")
+register("image-hashes", "images", "ImageHashFilter", types=("post", "comment"),
+		name="Image Spam and Repost Detection", descr="Matches linked images and thumbnails against known spam and recent things by perceptual hash", author="Enigma")
@@ -0,0 +1,99 @@
+__author__ = "Enigma"
+
+from spam_shark import Filter, FilterResult, PostFilter, CommentFilter, safe_format, extract_submission_links
+from rates import link_domain
+from logging import info, warning
+
+class BurstFilter(Filter, PostFilter, CommentFilter):
+	"""
+	Wiki configuration:
+		type: "author" or "domain" [required]
+		count: number of things that make a burst [required]
+		window: length of the burst window in seconds, up to an hour [required]
+		action: "remove", "message", "log", or "report" [optional, default "report"]
+		ignore: list of authors or domains to ignore [optional]
+	"""
+	
+	filter_id = "bursts"
+	filter_name = "Author and Domain Burst Detection"
+	filter_descr = "Acts on authors or domains posting many things in a short time"
+	filter_author = "Enigma"
+	
+	shared_state = True
+	
+	_actions = {
+		"remove": FilterResult.REMOVE,
+		"message": FilterResult.MESSAGE,
+		"log": FilterResult.LOG,
+		"report": FilterResult.REPORT
+	}
+	
+	def init_filter(self, configs):
+		self.rules = []
+		for i, config in enumerate(configs):
+			if not config.get("type") in ("author", "domain") or not "count" in config or not "window" in config:
+				warning("Rule {} needs a type, count and window".format(i+1))
+				continue
+			action = config.get("action", "report")
+			if not action in self._actions:
+				warning("Rule {} has invalid action \"{}\"".format(i+1, action))
+				continue
+			
+			self.rules.append({
+				"type": config["type"],
+				"count": config["count"],
+				"window": config["window"],
+				"action": self._actions[action],
+				"ignore": set(s.lower() for s in config.get("ignore", []))
+			})
+		
+		info("Rules: {}".format(len(self.rules)))
+		return False
+	
+	def process_post(self, post):
+		links = [post.url] if not post.is_self else extract_submission_links(post.selftext)
+		return self._check(post, links)
+	
+	def process_comment(self, comment):
+		return self._check(comment, extract_submission_links(comment.body))
+	
+	def _check(self, thing, links):
+		if self.rates is None:
+			return False
+		
+		author = thing.author.name.lower() if thing.author is not None else None
+		domains = set(filter(None, map(link_domain, links)))
+		for rule in self.rules:
+			if rule["type"] == "author":
+				keys = [author] if author is not None else []
+			else:
+				keys = domains
+			for key in keys:
+				if key in rule["ignore"]:
+					continue
+				count = self.rates.count(rule["type"]+":"+key, rule["window"], now=getattr(thing, "created_utc", None))
+				if count >= rule["count"]:
+					return self._get_response(rule, key, count)
+		return False
+	
+	@staticmethod
+	def _get_response(rule, key, count):
+		reason = "Burst: {} things from {} in {}s".format(count, key, rule["window"])
+		if rule["action"] == FilterResult.REPORT:
+			return rule["action"], reason
+		
+		title = "{} burst: {}".format(rule["type"].capitalize(), key)
+		body = "A burst of activity was detected.\n\n" \
+			   "* {kind}: {key}\n" \
+			   "* Things: {count} in {window} seconds\n" \
+			   "* User: {author}\n" \
+			   "* Permalink: {permalink}\n"
+		body = safe_format(body, kind=rule["type"].capitalize(), key=_escape(key), count=count, window=rule["window"])
+		title = _escape(title)
+		
+		if rule["action"] == FilterResult.MESSAGE:
+			return rule["action"], {"log": (title, body), "modmail": (title, body)}
+		return rule["action"], {"log": (title, body)}
+
+def _escape(text):
+	return text.replace("{", "{{").replace("}", "}}")
@@ -0,0 +1,102 @@
+__author__ = "Enigma"
+
+from spam_shark import Filter, FilterResult, PostFilter, CommentFilter, safe_format
+from cache import MinHashIndex, load_cached_storage
+from text_util import MinHasher, shingles, estimate_similarity
+from logging import info
+from time import time
+import config
+
+class CopypastaFilter(Filter, PostFilter, CommentFilter):
+	"""
+	Wiki configuration:
+		action: "remove", "message", "log", or "report" [optional, default "report"]
+		similarity: minimum estimated similarity from 0 to 1 [optional, default 0.7]
+		cluster_size: number of near-duplicates, including the new thing, needed to act [optional, default 4]
+		window: seconds of recent content to compare against [optional, default 21600]
+		min_length: ignore texts shorter than this many characters [optional, default 50]
+	"""
+	
+	filter_id = "copypasta"
+	filter_name = "Near-Duplicate Copypasta Detection"
+	filter_descr = "Catches the same text posted with small variations across many things"
+	filter_author = "Enigma"
+	
+	_actions = {
+		"remove": FilterResult.REMOVE,
+		"message": FilterResult.MESSAGE,
+		"log": FilterResult.LOG,
+		"report": FilterResult.REPORT
+	}
+	
+	shared_state = True
+	hasher = MinHasher(num_perm=64)
+	save_interval = 300
+	
+	def init_filter(self, configs):
+		c = configs[0] if len(configs) > 0 else {}
+		action = c.get("action", "report")
+		if not action in self._actions:
+			return "invalid action \"{}\"".format(action)
+		self.action = self._actions[action]
+		self.similarity = c.get("similarity", 0.7)
+		self.cluster_size = c.get("cluster_size", 4)
+		self.window = c.get("window", 21600)
+		self.min_length = c.get("min_length", 50)
+		
+		# Keep recent content across config reloads
+		if not hasattr(self, "index"):
+			index_file = config.cache_location+"/copypasta.cache"
+			self.index = load_cached_storage(index_file, factory=lambda: MinHashIndex(file=index_file))
+			self.last_save = time()
+		self.index.expiration = self.window
+		
+		info("Similarity: {}, cluster size: {}, window: {}s".format(self.similarity, self.cluster_size, self.window))
+		return False
+	
+	def update(self):
+		if time() - self.last_save >= self.save_interval:
+			self.index.save()
+			self.last_save = time()
+		yield False
+	
+	def process_post(self, post):
+		text = post.title
+		if post.is_self and post.selftext:
+			text += "\n" + post.selftext
+		return self._check(post, text)
+	
+	def process_comment(self, comment):
+		return self._check(comment, comment.body)
+	
+	def _check(self, thing, text):
+		if text is None or len(text) < self.min_length:
+			return False
+		
+		signature = self.hasher.signature(shingles(text))
+		created = thing.created_utc
+		
+		# Only the few items sharing an LSH band with this one are compared
+		cluster = 1
+		for item_id, other, other_created in self.index.candidates(signature):
+			if abs(created - other_created) <= self.window and estimate_similarity(signature, other) >= self.similarity:
+				cluster += 1
+		self.index.add(thing.fullname, signature, created)
+		
+		if cluster >= self.cluster_size:
+			return self._get_response(cluster)
+		return False
+	
+	def _get_response(self, cluster):
+		if self.action == FilterResult.REPORT:
+			return self.action, "Copypasta ({} near-duplicates)".format(cluster)
+		
+		title = "Copypasta detected"
+		body = "A thing was posted with {cluster} near-duplicates in the last {hours:.1f} hours.\n\n" \
+			   "* User: {author}\n" \
+			   "* Permalink: {permalink}\n"
+		body = safe_format(body, cluster=cluster, hours=self.window / 3600)
+		
+		if self.action == FilterResult.MESSAGE:
+			return self.action, {"log": (title, body), "modmail": (title, body)}
+		return self.action, {"log": (title, body)}
@@ -1,10 +1,9 @@
 __author__ = "Enigma"
 
-from spam_shark import Filter, FilterResult, LinkFilter, PostFilter, safe_format
+from spam_shark import Filter, FilterResult, LinkFilter, PostFilter, Template, safe_format
 import media_util
-from cache import TimedObjCache
 import config
-from logging import info, warning
+from logging import debug, info, warning
 
 class YouTubeChannelFilter(Filter, LinkFilter):
 	"""
@@ -18,12 +17,13 @@ class YouTubeChannelFilter(Filter, LinkFilter):
 	filter_descr = None
 	filter_author = "Enigma"
 	
-	ban_list = []
-	watch_list = []
+	ban_list = ()
+	watch_list = ()
 	
 	def init_filter(self, configs):
-		self.ban_list.clear()
-		self.watch_list.clear()
+		# Kept on the instance so snapshots restore them
+		self.ban_list = []
+		self.watch_list = []
 		
 		# Update successful
 		for config in configs:
@@ -80,7 +80,9 @@ class YouTubeChannelFilter(Filter, LinkFilter):
 class YouTubeVoteManipFilter(Filter, PostFilter):
 	"""
 	Wiki configuration:
-		None
+		check_after: seconds to wait before checking a video [optional]
+		uploader_only: only check comments by the video's uploader [optional, default false]
+		comment_pages: pages of up to 100 comments to check per video, 1 quota unit each [optional, default 3]
 	"""
 	
 	filter_id = "youtube-votemanip"
@@ -90,31 +92,34 @@ class YouTubeVoteManipFilter(Filter, PostFilter):
 	
 	def init_filter(self, configs):
 		ex = 300
-		if len(configs) > 0 and "check_after" in configs:
-			ex = configs["check_after"]
+		if len(configs) > 0 and "check_after" in configs[0]:
+			ex = configs[0]["check_after"]
 		info("Check after: {}".format(ex))
-		self.post_cache = TimedObjCache(expiration=ex)
+		self.check_after = ex
 		
-	def update(self):
-		to_check = self.post_cache._prune()
+		c = configs[0] if len(configs) > 0 else {}
+		self.uploader_only = c.get("uploader_only", False)
+		self.comment_pages = c.get("comment_pages", 3)
+		info("Comments: {} pages{}".format(self.comment_pages, ", uploader only" if self.uploader_only else ""))
+	
+	def process_job(self, job, post):
+		url = job.payload
 		
-		for url, post in to_check:
-			# Video description
-			desc = media_util.get_youtube_video_description(url)
-			if not desc is None and self._wow_such_vote_solicitation(desc):
-				yield self._get_response(url, post)
-			
-			# Video comments
-			# Might be better to only check uploader comments
-			comments = media_util.get_youtube_comments(url)
-			if not comments is None:
-				for comment in comments:
-					if self._wow_such_vote_solicitation(comment):
-						yield self._get_response(url, post)
+		# Video description
+		desc = media_util.get_youtube_video_description(url)
+		if not desc is None and self._wow_such_vote_solicitation(desc):
+			return self._get_response(url, post)
+		
+		# Video comments, fetched a page at a time until one matches
+		comments = media_util.iter_youtube_comments(url, self.uploader_only, self.comment_pages)
+		if any(self._wow_such_vote_solicitation(comment) for comment in comments):
+			return self._get_response(url, post)
+		
+		return False
 	
 	def process_post(self, post):
 		if not post.is_self and media_util.is_youtube_video(post.url):
-			self.post_cache.store(post.url, post)
+			self.schedule(post, self.check_after, payload=post.url)
 		return False
 	
 	@staticmethod
@@ -150,7 +155,7 @@ class YouTubeDurationFilter(Filter, PostFilter):
 	enabled = False
 	reply = None
 	
-	failed_posts = []
+	retry_after = 60
 	num_retries = 20
 	
 	def init_filter(self, configs):
@@ -170,34 +175,30 @@ class YouTubeDurationFilter(Filter, PostFilter):
 				info("Not enabled because there are no settings!")
 			
 			if "reply" in c:
-				self.reply = c["reply"]
+				# Parsed once here rather than every time a post is removed
+				self.reply = Template(c["reply"] + "\n\n---\n\n" \
+					"*This action was performed by a bot. If you believe it is a mistake, please [message the mods](https://reddit.com/message/compose?to=%2Fr%2F{subreddit}).*")
 				info("Reply:")
-				info(self.reply)
+				info(c["reply"])
 			else:
+				self.reply = None
 				info("Removing silently")
 			
 		return False
 	
-	def update(self):
-		failed = self.failed_posts[:]
-		self.failed_posts.clear()
-		
-		for post_tuple in failed:
-			post, retries = post_tuple
-			result = self.process_post(post)
-			if result > 0:
-				yield result
-			elif retries < self.num_retries:
-				self.failed_posts.append((post, retries+1))
-		
-		yield False
+	def process_job(self, job, post):
+		result = self.process_post(post, add_fail=False)
+		if result is None:
+			# Still no duration, back off and try again
+			self.jobs.retry(job)
+			return False
+		return result
 	
 	def process_post(self, post, add_fail=True):
 		if self.enabled and not post.is_self:
 			if media_util.is_youtube_video(post.url):
-				print("Checking video: {}".format(post.permalink))
 				length = media_util.get_youtube_video_duration(post.url)
-				print("  duration = {}".format(length))
+				debug("Video duration for {}: {}".format(post.permalink, length))
 				if length is not None:
 					if length > 0:
 						if self.min_dur > -1 and length < self.min_dur:
@@ -205,8 +206,10 @@ class YouTubeDurationFilter(Filter, PostFilter):
 						if self.max_dur > -1 and length > self.max_dur:
 							return self._get_response_max(post.url, post)
 					elif add_fail:
-						print("  Is none!")
-						self.failed_posts.append((post, 0))
+						debug("No duration yet, retrying later")
+						self.schedule(post, self.retry_after, max_attempts=self.num_retries)
+					else:
+						return None
 		return False
 	
 	def _get_response_min(self, video_url, post):
@@ -217,11 +220,7 @@ class YouTubeDurationFilter(Filter, PostFilter):
 			   "* Permalink: {permalink}\n"
 		body = safe_format(body, video_url=video_url)
 		
-		reply = self.reply + "\n\n---\n\n" \
-				"*This action was performed by a bot. If you believe it is a mistake, please [message the mods](https://reddit.com/message/compose?to=%2Fr%2F{subreddit}).*"
-		
-		print("Video too short!")
-		return FilterResult.REMOVE, {"log": (title, body), "reply": reply}
+		return FilterResult.REMOVE, {"log": (title, body), "reply": self.reply}
 	
 	def _get_response_max(self, video_url, post):
 		title = "YouTube video duration too long"
@@ -231,8 +230,4 @@ class YouTubeDurationFilter(Filter, PostFilter):
 			   "* Permalink: {permalink}\n"
 		body = safe_format(body, video_url=video_url)
 		
-		reply = self.reply + "\n\n---\n\n" \
-				"*This action was performed by a bot. If you believe it is a mistake, please [message the mods](https://reddit.com/message/compose?to=%2Fr%2F{subreddit}).*"
-		
-		print("Video too long!")
-		return FilterResult.REMOVE, {"log": (title, body), "reply": reply}
+		return FilterResult.REMOVE, {"log": (title, body), "reply": self.reply}
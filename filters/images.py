@@ -0,0 +1,166 @@
+__author__ = "Enigma"
+
+from spam_shark import Filter, FilterResult, PostFilter, CommentFilter, safe_format, extract_submission_links
+from cache import ImageHashIndex
+from logging import info, warning
+from time import time
+import config, media_util
+
+class ImageHashFilter(Filter, PostFilter, CommentFilter):
+	"""
+	Wiki configuration:
+		action: "remove", "message", "log", or "report" for images matching known spam [optional, default "report"]
+		hashes: list of known spam image hashes as 16 hex digits [optional]
+		learn: add images removed by this filter to the known spam [optional, default true]
+		repost_action: "remove", "message", "log", or "report" for images matching another recent thing [optional, default none]
+		repost_window: seconds images are kept for repost matching [optional, default 604800]
+		max_distance: number of differing hash bits still counted as a match [optional, default 6]
+	"""
+	
+	filter_id = "image-hashes"
+	filter_name = "Image Spam and Repost Detection"
+	filter_descr = "Matches linked images and thumbnails against known spam and recent things by perceptual hash"
+	filter_author = "Enigma"
+	
+	_actions = {
+		"remove": FilterResult.REMOVE,
+		"message": FilterResult.MESSAGE,
+		"log": FilterResult.LOG,
+		"report": FilterResult.REPORT
+	}
+	
+	max_images = 5
+	save_interval = 300
+	
+	learned = None
+	recent = None
+	
+	def init_filter(self, configs):
+		if len(configs) > 1:
+			warning("Too many configs!")
+		c = configs[0] if len(configs) > 0 else {}
+		
+		action = c.get("action", "report")
+		if not action in self._actions:
+			return "invalid action \"{}\"".format(action)
+		repost_action = c.get("repost_action")
+		if repost_action is not None and not repost_action in self._actions:
+			return "invalid repost action \"{}\"".format(repost_action)
+		self.action = self._actions[action]
+		self.repost_action = self._actions.get(repost_action)
+		self.learn = c.get("learn", True)
+		self.max_distance = c.get("max_distance", 6)
+		
+		try:
+			hashes = [int(h, 16) for h in c.get("hashes", [])]
+		except (TypeError, ValueError) as e:
+			return "invalid hash ({})".format(e)
+		
+		try:
+			import PIL
+			self.configured = ImageHashIndex()
+		except ImportError as e:
+			return "Pillow and NumPy are required ({})".format(e)
+		self.configured.add(hashes, ["config"] * len(hashes))
+		
+		# Learned and recent images are kept across config reloads
+		if self.recent is None:
+			self.learned = ImageHashIndex(file=config.cache_location+"/image-spam.npz")
+			self.recent = ImageHashIndex(file=config.cache_location+"/image-recent.npz")
+			self.last_save = time()
+		self.recent.expiration = c.get("repost_window", 604800)
+		
+		info("Known spam images: {} configured, {} learned".format(len(self.configured), len(self.learned)))
+		info("Reposts: {}".format(repost_action or "ignored"))
+		return False
+	
+	def update(self):
+		if self.recent is not None and time() - self.last_save >= self.save_interval:
+			self.learned.save()
+			self.recent.save()
+			self.last_save = time()
+		yield False
+	
+	def process_post(self, post):
+		links = [post.url] if not post.is_self else extract_submission_links(post.selftext)
+		urls = [link for link in links if media_util.is_image_link(link)]
+		if len(urls) == 0 and post.thumbnail and media_util.is_image_link(post.thumbnail):
+			urls.append(post.thumbnail)
+		return self._schedule_check(post, urls)
+	
+	def process_comment(self, comment):
+		urls = [link for link in extract_submission_links(comment.body) if media_util.is_image_link(link)]
+		return self._schedule_check(comment, urls)
+	
+	def _schedule_check(self, thing, urls):
+		# Images are hashed in a job, which always runs in the main process, so
+		# there's one set of indexes even when filters run in worker processes
+		if len(urls) > 0:
+			self.schedule(thing, 0, payload=urls[:self.max_images])
+		return False
+	
+	def process_job(self, job, thing):
+		return self._check(thing, job.payload)
+	
+	def _check(self, thing, urls):
+		# Downloads share half the filter's time budget. Each gets half of what's
+		# left, since a stalled read can take twice as long as its timeout.
+		deadline = time() + config.filter_time_budget / 2
+		hashes = []
+		for url in urls:
+			remaining = deadline - time()
+			if remaining <= 0:
+				warning("Out of time for images, {} of {} hashed".format(len(hashes), len(urls)))
+				break
+			image_hash = media_util.get_image_hash(url, timeout=remaining / 2)
+			if image_hash is not None:
+				hashes.append(image_hash)
+		if len(hashes) == 0:
+			return False
+		
+		# All of the thing's images are looked up in a single pass over each index
+		for index in (self.configured, self.learned):
+			for match in index.search(hashes, self.max_distance):
+				if match is not None:
+					if self.learn and self.action <= FilterResult.REMOVE:
+						self.learned.add(hashes, [thing.fullname] * len(hashes))
+					return self._get_spam_response(match[1])
+		
+		reposts = self.recent.search(hashes, self.max_distance)
+		self.recent.add(hashes, [thing.fullname] * len(hashes))
+		if self.repost_action is not None:
+			for match in reposts:
+				if match is not None and match[0] != thing.fullname:
+					return self._get_repost_response(*match)
+		return False
+	
+	def _get_spam_response(self, distance):
+		if self.action == FilterResult.REPORT:
+			return self.action, "Known spam image"
+		
+		title = "Known spam image"
+		body = "An image matching known spam was posted ({distance} of 64 hash bits differ).\n\n" \
+			   "* User: {author}\n" \
+			   "* Permalink: {permalink}\n"
+		body = safe_format(body, distance=distance)
+		return self._respond(self.action, title, body)
+	
+	def _get_repost_response(self, original, distance):
+		if original.startswith("t3_"):
+			original = "https://redd.it/"+original[3:]
+		if self.repost_action == FilterResult.REPORT:
+			return self.repost_action, "Image repost of {}".format(original)
+		
+		title = "Image repost"
+		body = "An image from the last {days:.0f} days was posted again.\n\n" \
+			   "* Original: {original}\n" \
+			   "* User: {author}\n" \
+			   "* Permalink: {permalink}\n"
+		body = safe_format(body, days=self.recent.expiration / 86400, original=original)
+		return self._respond(self.repost_action, title, body)
+	
+	@staticmethod
+	def _respond(action, title, body):
+		if action == FilterResult.MESSAGE:
+			return action, {"log": (title, body), "modmail": (title, body)}
+		return action, {"log": (title, body)}
@@ -0,0 +1,151 @@
+__author__ = "Enigma"
+
+from spam_shark import Filter, FilterResult, PostFilter, CommentFilter, safe_format
+from text_util import PhraseMatcher, is_whole_word
+from logging import info, warning
+import re
+
+class PhraseFilter(Filter, PostFilter, CommentFilter):
+	"""
+	Wiki configuration:
+		action: "remove", "message", "log", or "report" [required]
+		phrases: list of phrases, matched case-insensitively [optional]
+		regexes: list of regular expressions, matched case-insensitively [optional]
+		fields: list of "title" and/or "body" to check [optional, default both]
+		whole_words: only match phrases on word boundaries [optional, default true]
+		reason: rule description used in logs and reports [optional]
+	"""
+	
+	filter_id = "phrases"
+	filter_name = "Phrase and Regex Matching"
+	filter_descr = "Matches titles and bodies against large phrase and regex lists"
+	filter_author = "Enigma"
+	
+	_actions = {
+		"remove": FilterResult.REMOVE,
+		"message": FilterResult.MESSAGE,
+		"log": FilterResult.LOG,
+		"report": FilterResult.REPORT
+	}
+	
+	def init_filter(self, configs):
+		self.rules = []
+		self.matcher = PhraseMatcher()
+		self.patterns = []
+		
+		regex_count = 0
+		for i, config in enumerate(configs):
+			action = config.get("action")
+			if not action in self._actions:
+				warning("Rule {} has invalid action \"{}\"".format(i+1, action))
+				continue
+			
+			rule_id = len(self.rules)
+			self.rules.append({
+				"action": self._actions[action],
+				"reason": config.get("reason", "Phrase rule {}".format(i+1)),
+				"fields": set(config.get("fields", ["title", "body"])),
+				"whole_words": config.get("whole_words", True)
+			})
+			
+			for phrase in config.get("phrases", []):
+				phrase = str(phrase).strip()
+				if len(phrase) > 0:
+					self.matcher.add(phrase, rule_id)
+			
+			patterns = _compile_regexes(config.get("regexes", []))
+			self.patterns.extend((rule_id, pattern) for pattern in patterns)
+			regex_count += len(patterns)
+		
+		# Phrases are scanned in a single pass per field
+		self.matcher.build()
+		
+		info("Rules: {}, phrase states: {}, regex patterns: {}".format(len(self.rules), len(self.matcher), regex_count))
+		return False
+	
+	def process_post(self, post):
+		fields = [("title", post.title)]
+		if post.is_self:
+			fields.append(("body", post.selftext))
+		return self._check(fields)
+	
+	def process_comment(self, comment):
+		return self._check([("body", comment.body)])
+	
+	def _check(self, fields):
+		best = None
+		for field, text in fields:
+			if not text:
+				continue
+			for rule_id, match in self._find(field, text):
+				if best is None or self.rules[rule_id]["action"] < self.rules[best[0]]["action"]:
+					best = rule_id, match
+				# Nothing is more severe than removal
+				if self.rules[rule_id]["action"] <= FilterResult.REMOVE:
+					return self._get_response(*best)
+		
+		if best is None:
+			return False
+		return self._get_response(*best)
+	
+	def _find(self, field, text):
+		for start, end, rule_id in self.matcher.finditer(text):
+			rule = self.rules[rule_id]
+			if field in rule["fields"] and (not rule["whole_words"] or is_whole_word(text, start, end)):
+				yield rule_id, text[start:end]
+		
+		# Every rule's patterns are searched, so one rule can't hide another
+		for rule_id, pattern in self.patterns:
+			if field in self.rules[rule_id]["fields"]:
+				match = pattern.search(text)
+				if match is not None:
+					yield rule_id, match.group(0)
+	
+	def _get_response(self, rule_id, matched):
+		rule = self.rules[rule_id]
+		action = rule["action"]
+		if action == FilterResult.REPORT:
+			return action, rule["reason"]
+		
+		title = "Phrase rule matched: {}".format(rule["reason"])
+		body = "A thing matched a phrase rule.\n\n" \
+			   "* Rule: {reason}\n" \
+			   "* Matched: {matched}\n" \
+			   "* User: {author}\n" \
+			   "* Permalink: {permalink}\n"
+		body = safe_format(body, reason=_escape(rule["reason"]), matched=_escape(matched))
+		title = _escape(title)
+		
+		if action == FilterResult.MESSAGE:
+			return action, {"log": (title, body), "modmail": (title, body)}
+		return action, {"log": (title, body)}
+
+def _compile_regexes(regexes):
+	"""
+	Compiles a rule's regexes case-insensitively. Plain regexes are combined
+	into one pattern; those with groups or inline flags are kept on their own
+	since they'd change meaning in the combined pattern.
+	"""
+	default_flags = re.compile("", flags=re.IGNORECASE).flags
+	patterns = []
+	plain = []
+	for regex in regexes:
+		try:
+			pattern = re.compile(regex, flags=re.IGNORECASE)
+		except (re.error, TypeError) as e:
+			warning("Skipping invalid regex \"{}\" ({})".format(regex, e))
+			continue
+		if pattern.groups > 0 or pattern.flags != default_flags:
+			patterns.append(pattern)
+		else:
+			plain.append(regex)
+	
+	if len(plain) > 0:
+		try:
+			patterns.append(re.compile("|".join("(?:{})".format(regex) for regex in plain), flags=re.IGNORECASE))
+		except re.error:
+			patterns.extend(re.compile(regex, flags=re.IGNORECASE) for regex in plain)
+	return patterns
+
+def _escape(text):
+	return text.replace("{", "{{").replace("}", "}}")
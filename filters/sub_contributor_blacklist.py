@@ -1,10 +1,15 @@
 __author__ = "Enigma"
 
 from spam_shark import Filter, FilterResult, PostFilter, CommentFilter, safe_format
+from cache import open_obj_cache
 from functools import lru_cache
+from logging import warning
 import types
 import reddit_util
 
+# Shared with other instances when the sqlite cache backend is used
+_history_cache = open_obj_cache("user-subreddits", 86400)
+
 class SubContributorBlacklist(Filter, PostFilter, CommentFilter):
 	"""
 	Wiki configuration:
@@ -22,9 +27,9 @@ class SubContributorBlacklist(Filter, PostFilter, CommentFilter):
 	
 	def init_filter(self, configs):
 		if len(configs) < 1:
-			print("Warning: config block needed")
+			warning("Config block needed")
 		elif len(configs) > 1:
-			print("Warning: only one config block needed")
+			warning("Only one config block needed")
 		else:
 			config = configs[0]
 			if "blacklist" in config:
@@ -72,13 +77,24 @@ class SubContributorBlacklist(Filter, PostFilter, CommentFilter):
 	@classmethod
 	@lru_cache(maxsize=512)
 	def _get_user_subreddits(cls, user):
+		key = user.name.lower()
+		subs = _history_cache.get(key)
+		if subs is not None:
+			return subs
+		
+		# Deferred by run_filter if the request budget is tight
+		reddit_util.acquire(reddit_util.PRIORITY_HISTORY, 2)
+		
 		thing_to_sub = lambda t: t.subreddit._fast_name
 		
-		comments = reddit_util.get_all_comments(user, limit=100, save_last=False)
+		redditor = reddit_util.get_redditor(reddit_util.session, user.name)
+		comments = reddit_util.get_all_comments(redditor, limit=100, save_last=False)
 		comments = set(map(thing_to_sub, comments))
-		posts = reddit_util.get_all_submitted(user, limit=100, save_last=False)
+		posts = reddit_util.get_all_submitted(redditor, limit=100, save_last=False)
 		posts = set(map(thing_to_sub, posts))
-		return comments.union(posts)
+		subs = comments.union(posts)
+		_history_cache.store(key, subs)
+		return subs
 
 class ObjectWrapper():
 	"""
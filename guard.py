@@ -0,0 +1,136 @@
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+from threading import Thread, Lock
+from queue import Queue
+from time import time
+import logging
+
+# Circuit states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+class FilterTimeout(Exception):
+	pass
+
+class CircuitOpen(Exception):
+	pass
+
+class RetryLater(Exception):
+	"""
+	Raised by filter code that can't run right now (e.g. out of API budget).
+	The thing is deferred without counting as a failure.
+	"""
+	pass
+
+class _Worker(Thread):
+	"""
+	Daemon thread running calls for a single filter, so a hung filter can be
+	abandoned without blocking the processing thread or interpreter exit.
+	"""
+	
+	def __init__(self, name):
+		super().__init__(name=name, daemon=True)
+		self.calls = Queue()
+	
+	def run(self):
+		while True:
+			future, func, args, kwargs = self.calls.get()
+			if not future.set_running_or_notify_cancel():
+				continue
+			try:
+				future.set_result(func(*args, **kwargs))
+			except BaseException as e:
+				future.set_exception(e)
+
+class FilterGuard:
+	"""
+	Runs filter calls under a time budget and trips a circuit breaker after
+	repeated timeouts or errors. While open, calls are refused until the
+	cooldown passes, after which a single probe call is let through.
+	A call that overruns its budget can't be stopped, so no other call is
+	started until it finishes.
+	"""
+	
+	def __init__(self, name, budget=10, max_failures=3, cooldown=300, max_deferred=500):
+		self.name = name
+		self.budget = budget
+		self.max_failures = max_failures
+		self.cooldown = cooldown
+		
+		self.state = CLOSED
+		self.failures = 0
+		self.opened_at = 0
+		self.deferred = deque(maxlen=max_deferred)
+		
+		self._lock = Lock()
+		self._worker = None
+		self._overrun = None
+	
+	def allow(self):
+		with self._lock:
+			if self.state == OPEN and time() - self.opened_at >= self.cooldown:
+				logging.info("Probing filter {}".format(self.name))
+				self.state = HALF_OPEN
+				return True
+			return self.state == CLOSED
+	
+	def call(self, func, *args, budget=None, **kwargs):
+		# Filter state isn't safe to share with a timed-out call still running
+		if self._overrun is not None:
+			if not self._overrun.done():
+				raise CircuitOpen("{} is still running a timed-out call".format(self.name))
+			self._overrun = None
+		
+		if not self.allow():
+			raise CircuitOpen(self.name)
+		
+		if self._worker is None:
+			self._worker = _Worker("SpamShark-filter-"+self.name)
+			self._worker.start()
+		
+		future = Future()
+		self._worker.calls.put((future, func, args, kwargs))
+		budget = budget or self.budget
+		try:
+			result = future.result(timeout=budget)
+		except TimeoutError:
+			self._overrun = future
+			self._record_failure()
+			raise FilterTimeout("{} exceeded {}s".format(self.name, budget))
+		except RetryLater:
+			# Neither a success nor a failure, a probe just gets another go
+			with self._lock:
+				if self.state == HALF_OPEN:
+					self.state = OPEN
+			raise
+		except Exception:
+			self._record_failure()
+			raise
+		
+		self._record_success()
+		return result
+	
+	def defer(self, *item):
+		self.deferred.append(item)
+	
+	def take_deferred(self):
+		items = list(self.deferred)
+		self.deferred.clear()
+		return items
+	
+	def _record_success(self):
+		with self._lock:
+			if self.state != CLOSED:
+				logging.info("Filter {} recovered".format(self.name))
+			self.state = CLOSED
+			self.failures = 0
+	
+	def _record_failure(self):
+		with self._lock:
+			self.failures += 1
+			if self.state == HALF_OPEN or self.failures >= self.max_failures:
+				if self.state != OPEN:
+					logging.warning("Disabling filter {} for {}s after {} failures".format(self.name, self.cooldown, self.failures))
+				self.state = OPEN
+				self.opened_at = time()
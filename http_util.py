@@ -0,0 +1,44 @@
+from logging import info
+
+# Conditional requests
+# Responses carrying an ETag or Last-Modified header are stored with their
+# validators. The next request for the same resource asks the server whether
+# it changed, and a 304 reuses the stored body instead of downloading it again.
+
+stats = {"requests": 0, "not_modified": 0, "bytes_saved": 0}
+
+def conditional_get(session, url, validators, key=None, headers=None, **kwargs):
+	"""
+	GETs a URL with requests (or a requests session), revalidating the copy
+	stored in the validators cache if there is one.
+	Returns the status code and body text. A 304 returns 200 and the stored body.
+	"""
+	key = key or url
+	headers = dict(headers or {})
+	entry = validators.get(key)
+	if entry is not None:
+		etag, modified, body = entry
+		if etag is not None:
+			headers["If-None-Match"] = etag
+		if modified is not None:
+			headers["If-Modified-Since"] = modified
+	
+	response = session.get(url, headers=headers, **kwargs)
+	stats["requests"] += 1
+	
+	if response.status_code == 304 and entry is not None:
+		stats["not_modified"] += 1
+		stats["bytes_saved"] += len(entry[2].encode("utf-8"))
+		validators.store(key, entry)
+		return 200, entry[2]
+	
+	if response.status_code == 200:
+		etag = response.headers.get("ETag")
+		modified = response.headers.get("Last-Modified")
+		if etag is not None or modified is not None:
+			validators.store(key, (etag, modified, response.text))
+	return response.status_code, response.text
+
+def log_stats():
+	if stats["requests"] > 0:
+		info("Conditional requests: {requests}, not modified: {not_modified}, bytes saved: {bytes_saved}".format(**stats))
@@ -0,0 +1,104 @@
+from time import time
+import heapq
+from cache import Cache
+
+class Job:
+	"""
+	A delayed check of a single thing, stored compactly by fullname so it can
+	be persisted across restarts.
+	"""
+	
+	def __init__(self, key, filter_id, fullname, due, delay, payload=None, max_attempts=20):
+		self.key = key
+		self.filter_id = filter_id
+		self.fullname = fullname
+		self.due = due
+		self.delay = delay
+		self.payload = payload
+		self.attempts = 0
+		self.max_attempts = max_attempts
+
+class JobQueue(Cache):
+	"""
+	Priority queue of delayed jobs, deduplicated by key. Retried jobs back off
+	exponentially from their initial delay. Changes are only written out when
+	save() is called, and only if there are any.
+	"""
+	
+	def __init__(self, file=None, max_delay=3600):
+		super().__init__(file)
+		
+		self.max_delay = max_delay
+		self._jobs = {}
+		self._heap = []
+		self._seq = 0
+		self._dirty = False
+	
+	def submit(self, filter_id, key, fullname, delay, payload=None, max_attempts=20):
+		if key in self._jobs:
+			return False
+		job = Job(key, filter_id, fullname, time() + delay, delay, payload, max_attempts)
+		self._push(job)
+		return True
+	
+	def retry(self, job):
+		job.attempts += 1
+		if job.attempts > job.max_attempts:
+			return False
+		delay = min(max(job.delay, 1) * 2 ** job.attempts, self.max_delay)
+		job.due = time() + delay
+		self._push(job)
+		return True
+	
+	def restore(self, jobs):
+		"""
+		Puts popped jobs back unchanged, such as when running them failed.
+		"""
+		for job in jobs:
+			if not job.key in self._jobs:
+				self._push(job)
+	
+	def cancel(self, key):
+		if self._jobs.pop(key, None) is not None:
+			self._dirty = True
+	
+	def pop_due(self, now=None):
+		"""
+		Removes and returns all jobs that are due, oldest first.
+		"""
+		if now is None:
+			now = time()
+		
+		due = []
+		while len(self._heap) > 0 and self._heap[0][0] <= now:
+			job_due, seq, key = heapq.heappop(self._heap)
+			job = self._jobs.get(key)
+			# Skip entries left behind by cancelled or rescheduled jobs
+			if job is None or job.due != job_due:
+				continue
+			del self._jobs[key]
+			due.append(job)
+		if len(due) > 0:
+			self._dirty = True
+		return due
+	
+	def _push(self, job):
+		self._jobs[job.key] = job
+		self._seq += 1
+		heapq.heappush(self._heap, (job.due, self._seq, job.key))
+		self._dirty = True
+	
+	def save(self):
+		# Queues pickled before the flag existed are saved once to be safe
+		if getattr(self, "_dirty", True):
+			super().save()
+			self._dirty = False
+	
+	def data(self):
+		return self._jobs
+	
+	def __iter__(self):
+		return iter(self._jobs.values())
+	
+	def __len__(self):
+		return len(self._jobs)
@@ -0,0 +1,82 @@
+from time import time
+from logging import info, warning
+import os, json
+
+class ActionJournal:
+	"""
+	Append-only record of moderation actions taken, keyed by thing fullname
+	and action. Each action is flushed to disk as soon as it's taken, so
+	things reprocessed after a crash or a lost cache aren't actioned twice.
+	Entries older than the retention period are dropped when compacting.
+	"""
+	
+	def __init__(self, file, retention=604800, compact_every=5000):
+		self.file = file
+		self.retention = retention
+		self.compact_every = compact_every
+		
+		self._actions = {}
+		self._appended = 0
+		self._handle = None
+		
+		self._load()
+		self.compact()
+	
+	def _load(self):
+		if not os.path.exists(self.file):
+			return
+		
+		with open(self.file, "r", encoding="utf-8") as file:
+			for line in file:
+				try:
+					entry = json.loads(line)
+					self._actions[(entry["thing"], entry["action"])] = entry["time"]
+				except (ValueError, KeyError, TypeError):
+					# Partial last line from a crash mid-write
+					continue
+		info("Loaded {} journaled actions".format(len(self._actions)))
+	
+	def has(self, fullname, action):
+		return (fullname, action) in self._actions
+	
+	def record(self, fullname, action):
+		now = time()
+		self._actions[(fullname, action)] = now
+		
+		if self._handle is None:
+			self._handle = open(self.file, "a", encoding="utf-8")
+		self._handle.write(json.dumps({"thing": fullname, "action": action, "time": now})+"\n")
+		self._handle.flush()
+		os.fsync(self._handle.fileno())
+		
+		self._appended += 1
+		if self._appended >= self.compact_every:
+			self.compact()
+	
+	def compact(self):
+		"""
+		Rewrites the journal with only the entries still within the retention period.
+		"""
+		cutoff = time() - self.retention
+		self._actions = {k: t for k, t in self._actions.items() if t >= cutoff}
+		self.close()
+		
+		temp_file = self.file+".tmp"
+		try:
+			with open(temp_file, "w", encoding="utf-8") as file:
+				for (fullname, action), when in self._actions.items():
+					file.write(json.dumps({"thing": fullname, "action": action, "time": when})+"\n")
+				file.flush()
+				os.fsync(file.fileno())
+			os.replace(temp_file, self.file)
+		except OSError as e:
+			warning("Failed to compact action journal ({})".format(e))
+		self._appended = 0
+	
+	def close(self):
+		if self._handle is not None:
+			self._handle.close()
+			self._handle = None
+	
+	def __len__(self):
+		return len(self._actions)
@@ -0,0 +1,164 @@
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Queue
+from time import time
+import logging, json, copy
+
+# Logging setup
+# Records are queued by the processing thread and written by a background
+# listener thread, so slow disks or consoles never hold up moderation.
+# Worker processes queue their records to the same listener.
+
+_listener = None
+_worker_listener = None
+
+def init_logging(log_file=None, level=logging.INFO, max_bytes=10*1024*1024, backup_count=5, repeat_interval=60):
+	"""
+	Routes all logging through a queue. With a log file, records are written
+	as JSON lines to a size-rotated file, otherwise as text to the console.
+	"""
+	global _listener
+	stop_logging()
+	
+	if log_file is not None:
+		handler = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+		handler.setFormatter(JsonFormatter())
+	else:
+		handler = logging.StreamHandler()
+		handler.setFormatter(logging.Formatter("%(levelname)s | %(message)s"))
+	
+	queue = Queue(-1)
+	_route_to_queue(queue, level, repeat_interval)
+	
+	_listener = QueueListener(queue, handler, respect_handler_level=True)
+	_listener.start()
+
+def share_logging(context):
+	"""
+	Returns a queue for worker processes of the given multiprocessing context
+	to log to with init_worker_logging, or None if logging isn't set up.
+	Their records are written by the same handler as this process's.
+	"""
+	global _worker_listener
+	if _listener is None:
+		return None
+	
+	if _worker_listener is None:
+		queue = context.Queue(-1)
+		_worker_listener = QueueListener(queue, *_listener.handlers, respect_handler_level=True)
+		_worker_listener.start()
+	return _worker_listener.queue
+
+def init_worker_logging(queue, level, repeat_interval=60):
+	"""
+	Routes a worker process's logging to the queue from share_logging.
+	"""
+	_route_to_queue(queue, level, repeat_interval)
+
+def _route_to_queue(queue, level, repeat_interval):
+	queue_handler = _StructuredQueueHandler(queue)
+	queue_handler.addFilter(RepeatFilter(repeat_interval))
+	
+	root = logging.getLogger()
+	for old in list(root.handlers):
+		root.removeHandler(old)
+	root.addHandler(queue_handler)
+	root.setLevel(level)
+
+def stop_logging():
+	"""
+	Flushes queued records and stops the writer thread.
+	"""
+	global _listener, _worker_listener
+	if _worker_listener is not None:
+		_worker_listener.stop()
+		_worker_listener = None
+	if _listener is not None:
+		_listener.stop()
+		_listener = None
+
+def thing_fields(thing=None, filter_id=None, latency=None):
+	"""
+	Structured fields for a record, passed as `extra` to logging calls.
+	"""
+	fields = {}
+	if thing is not None:
+		fields["fullname"] = getattr(thing, "fullname", None)
+	if filter_id is not None:
+		fields["filter_id"] = filter_id
+	if latency is not None:
+		fields["latency"] = round(latency, 3)
+	return fields
+
+# Formatting and filtering
+
+class _StructuredQueueHandler(QueueHandler):
+	"""
+	Queues records with the message formatted but the traceback kept apart
+	in exc_text, instead of folded into the message, so formatters can still
+	put it in its own field. Records can be pickled for other processes.
+	"""
+	
+	_formatter = logging.Formatter()
+	
+	def prepare(self, record):
+		record = copy.copy(record)
+		if record.exc_info:
+			record.exc_text = self._formatter.formatException(record.exc_info)
+		record.msg = record.getMessage()
+		record.args = None
+		record.exc_info = None
+		return record
+
+class JsonFormatter(logging.Formatter):
+	_fields = ("fullname", "filter_id", "latency", "suppressed")
+	
+	def format(self, record):
+		entry = {
+			"time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+			"level": record.levelname,
+			"logger": record.name,
+			"process": record.processName,
+			"thread": record.threadName,
+			"message": record.getMessage()
+		}
+		for field in self._fields:
+			value = getattr(record, field, None)
+			if value is not None:
+				entry[field] = value
+		if record.exc_info:
+			entry["exception"] = self.formatException(record.exc_info)
+		elif record.exc_text:
+			entry["exception"] = record.exc_text
+		return json.dumps(entry)
+
+class RepeatFilter(logging.Filter):
+	"""
+	Drops warnings and errors repeating the same message within the interval.
+	The next one let through carries the number dropped in `suppressed`.
+	"""
+	
+	def __init__(self, interval=60, max_keys=1000):
+		super().__init__()
+		self.interval = interval
+		self.max_keys = max_keys
+		self._seen = {}
+	
+	def filter(self, record):
+		if record.levelno < logging.WARNING:
+			return True
+		
+		key = (record.levelno, record.getMessage())
+		now = time()
+		last, suppressed = self._seen.get(key, (0, 0))
+		if now - last < self.interval:
+			self._seen[key] = (last, suppressed + 1)
+			return False
+		
+		if suppressed > 0:
+			record.suppressed = suppressed
+			record.msg = "{} ({} similar suppressed)".format(record.getMessage(), suppressed)
+			record.args = None
+		if len(self._seen) >= self.max_keys:
+			self._seen = {k: v for k, v in self._seen.items() if now - v[0] < self.interval}
+		self._seen[key] = (now, 0)
+		return True
@@ -1,18 +1,21 @@
 from functools import lru_cache
-import requests, re, isodate
-from cache import TimedObjCache
-import config
+from urllib.parse import urlparse
+import requests, re, json
+from cache import open_obj_cache
+from logging import warning
+import config, http_util
 
 # YouTube utilities
 
 _yt_sigs = ["youtube.com", "youtu.be"]
 _yt_headers = {"User-Agent": config.useragent}
-_yt_api_base = "https://www.googleapis.com/youtube/v3/"
+_yt_api_base = config.youtube_api_url
 _yt_video_url = _yt_api_base+"videos?part={type}&id={id}"
 _yt_playlist_url = _yt_api_base+"playlists?part={type}&id={id}"
-_yt_comments_url = _yt_api_base+"commentThreads?part={type}&textFormat=plainText&videoId={id}"
+_yt_comments_url = _yt_api_base+"commentThreads?part={type}&textFormat=plainText&maxResults=100&videoId={id}"
 _yt_last_time = 0
-_yt_cache = TimedObjCache(expiration=1800)	# 30 min
+_yt_cache = open_obj_cache("youtube", 1800)	# 30 min
+_yt_validators = open_obj_cache("youtube-validators", 86400)	# Revalidated once _yt_cache expires
 
 _yt_video_pattern = re.compile("(?:youtube\.com/(?:(?:watch|attribution_link)\?(?:.*(?:&|%3F|&amp;))?v(?:=|%3D)|embed/|v/)|youtu\.be/)([a-zA-Z0-9-_]{11})")
 _yt_playlist_pattern = re.compile("youtube\.com/playlist\?list=([a-zA-Z0-9-_]+)")
@@ -123,31 +126,58 @@ def get_youtube_video_duration(url):
 		
 		video_info = response["items"][0]
 		if video_info["kind"] == "youtube#video" and "contentDetails" in video_info:	# Sanity check
+			import isodate
 			duration = video_info["contentDetails"]["duration"]
 			duration = isodate.parse_duration(duration).total_seconds()
 			return duration
 	
 	return None
 
-def get_youtube_comments(url):
+def get_youtube_comments(url, uploader_only=False, max_pages=1):
+	comments = list(iter_youtube_comments(url, uploader_only, max_pages))
+	if len(comments) == 0:
+		return None
+	return comments
+
+def iter_youtube_comments(url, uploader_only=False, max_pages=1):
+	"""
+	Yields the text of top-level comments on a video, requesting each page of
+	comment threads (1 quota unit each) only when the previous one has been
+	consumed, so stopping early saves quota. With uploader_only, only comments
+	by the video's channel are yielded.
+	"""
 	video_id = _get_youtube_video_id(url)
-	if not video_id is None:
-		url = _yt_comments_url.format(type="snippet", id=video_id)
-		response = _youtube_request(url)
-		if response is None or len(response["items"]) == 0:
-			return None
+	if video_id is None:
+		return
+	
+	channel_id = None
+	if uploader_only:
+		channel_info = _get_channel_from_video(video_id)
+		if channel_info is None:
+			return
+		channel_id = channel_info[0]
+	
+	page_token = None
+	for page in range(max_pages):
+		request_url = _yt_comments_url.format(type="snippet", id=video_id)
+		if page_token is not None:
+			request_url += "&pageToken="+page_token
+		response = _youtube_request(request_url)
+		if response is None:
+			return
 		
-		comment_threads = response["items"]
-		whargarbl = []
-		for comment_thread in comment_threads:
+		for comment_thread in response.get("items", []):
 			comment = comment_thread["snippet"]["topLevelComment"]["snippet"]
+			if channel_id is not None and comment.get("authorChannelId", {}).get("value") != channel_id:
+				continue
 			text = comment["textDisplay"]
 			if text.endswith("\ufeff"):
 				text = text[:-1]
-			whargarbl.append(text)
-		return whargarbl
+			yield text
 		
-	return None
+		page_token = response.get("nextPageToken")
+		if page_token is None:
+			return
 
 def _youtube_request(request_url):
 	global _yt_last_time
@@ -159,17 +189,104 @@ def _youtube_request(request_url):
 	url = request_url+"&key="+config.youtube_api_key
 	
 	_yt_last_time = _requst_wait(_yt_last_time, 0.25)
-	response = requests.get(url, headers=_yt_headers)
+	status, body = http_util.conditional_get(requests, url, _yt_validators, key=request_url, headers=_yt_headers)
 	
-	if response.status_code == 200:
+	if status == 200:
 		#print("Success!")
-		good_stuff = response.json()
+		good_stuff = json.loads(body)
 		_yt_cache.store(request_url, good_stuff)
 		return good_stuff
 	else:
-		print("YouTube request failed ({}): {}".format(response.status_code, url))
+		warning("YouTube request failed ({}): {}".format(status, request_url))
 		return None
 
+# Image utilities
+
+_image_hosts = ("i.redd.it", "i.imgur.com")
+_image_extensions = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp")
+_image_headers = {"User-Agent": config.useragent}
+_image_max_bytes = 10*1024*1024
+_image_hashes = open_obj_cache("image-hashes", 86400)	# 1 day
+
+_imgur_pattern = re.compile("^https?://(?:www\.|m\.)?imgur\.com/([a-zA-Z0-9]{5,8})$")
+
+def get_image_url(url):
+	"""
+	Returns a direct URL to the image a link points at, or None if it isn't an image link.
+	"""
+	match = _imgur_pattern.match(url)
+	if match:
+		return "https://i.imgur.com/{}.jpg".format(match.group(1))
+	
+	parsed = urlparse(url)
+	if parsed.scheme in ("http", "https") \
+			and (parsed.netloc.lower() in _image_hosts or parsed.path.lower().endswith(_image_extensions)):
+		return url
+	return None
+
+def is_image_link(url):
+	return get_image_url(url) is not None
+
+def get_image_hash(url, timeout=10):
+	"""
+	Returns the perceptual hash of a linked image, or None if it can't be
+	downloaded or decoded. Downloads are given up after timeout seconds, a
+	stalled read can take up to another timeout to notice.
+	"""
+	image_url = get_image_url(url)
+	if image_url is None:
+		return None
+	
+	cache_result = _image_hashes.get(image_url)
+	if cache_result is not None:
+		return cache_result
+	
+	deadline = time() + timeout
+	try:
+		response = requests.get(image_url, headers=_image_headers, timeout=timeout, stream=True)
+		if response.status_code != 200:
+			warning("Image request failed ({}): {}".format(response.status_code, image_url))
+			return None
+		
+		data = bytearray()
+		for block in response.iter_content(65536):
+			data.extend(block)
+			if len(data) > _image_max_bytes:
+				warning("Image too large: {}".format(image_url))
+				return None
+			if time() > deadline:
+				warning("Image download too slow: {}".format(image_url))
+				return None
+		image_hash = hash_image(bytes(data))
+	except Exception as e:
+		warning("Failed to hash image {} ({})".format(image_url, e))
+		return None
+	
+	_image_hashes.store(image_url, image_hash)
+	return image_hash
+
+def hash_image(data):
+	"""
+	Difference hash (dHash) of image data: one bit per pair of horizontally
+	adjacent pixels in a 9x8 grayscale thumbnail, set where the left one is
+	brighter. Survives rescaling, recompression and small edits, and similar
+	images differ in only a few bits.
+	Requires Pillow.
+	"""
+	from PIL import Image
+	from io import BytesIO
+	
+	image = Image.open(BytesIO(data))
+	image.draft("L", (64, 64))	# Lets JPEGs decode at a fraction of their size
+	pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+	
+	bits = 0
+	for row in range(8):
+		for col in range(8):
+			i = row * 9 + col
+			bits = (bits << 1) | (1 if pixels[i] > pixels[i+1] else 0)
+	return bits
+
 # Misc. helpers
 
 from time import time, sleep
@@ -0,0 +1,57 @@
+from logging import debug
+from cache import Cache
+
+class FilterStats(Cache):
+	"""
+	Decaying average cost and hit rate of each filter method, where a hit is a
+	result that removes the thing. Evaluation stops at the first of those, so
+	running filters by cost over hit rate (cheapest per hit first) minimizes
+	the expected cost per thing.
+	"""
+	
+	def __init__(self, decay=0.01, file=None):
+		super().__init__(file)
+		self.decay = decay
+		self._stats = {}
+		self._orders = {}
+	
+	def record(self, filter_id, method, cost, hit):
+		key = (filter_id, method)
+		calls, hits, total_cost = self._stats.get(key, (0, 0, 0))
+		keep = 1 - self.decay
+		self._stats[key] = (calls * keep + 1, hits * keep + (1 if hit else 0), total_cost * keep + cost)
+	
+	def rank(self, filter_id, method):
+		"""
+		Expected seconds spent per hit. Filters without history rank first so
+		they get measured.
+		"""
+		calls, hits, total_cost = self._stats.get((filter_id, method), (0, 0, 0))
+		if calls == 0:
+			return 0
+		hit_rate = (hits + 1) / (calls + 2)
+		return total_cost / calls / hit_rate
+	
+	def order(self, filters, method, pinned=()):
+		"""
+		Sorts filters for a method, pinned filter IDs first in the given order.
+		"""
+		pinned = {filter_id: i for i, filter_id in enumerate(pinned)}
+		def key(f):
+			if f.filter_id in pinned:
+				return 0, pinned[f.filter_id]
+			return 1, self.rank(f.filter_id, method)
+		
+		ordered = sorted(filters, key=key)
+		ids = tuple(f.filter_id for f in ordered)
+		if self._orders.get(method) != ids:
+			self._orders[method] = ids
+			if len(ids) > 1:
+				debug("Filter order for {}: {}".format(method, ", ".join(ids)))
+		return ordered
+	
+	def data(self):
+		return self._stats
+	
+	def __iter__(self):
+		return self._stats.__iter__()
@@ -0,0 +1,51 @@
+from time import time
+import logging
+
+class AdaptivePoller:
+	"""
+	Poll interval for a single listing. Shrinks when polls come back full of
+	new items (raids) and grows while nothing new shows up, always staying
+	between the given bounds.
+	"""
+	
+	def __init__(self, name, min_interval, max_interval, speedup=0.5, slowdown=1.5, busy_ratio=0.5):
+		self.name = name
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.speedup = speedup
+		self.slowdown = slowdown
+		self.busy_ratio = busy_ratio
+		
+		self.interval = min_interval
+		self.next_poll = 0
+	
+	def poll(self):
+		"""
+		Returns True if a poll is due. The next poll is provisionally scheduled
+		a full interval ahead so a failed poll isn't immediately retried.
+		"""
+		now = time()
+		if now < self.next_poll:
+			return False
+		self.next_poll = now + self.interval
+		return True
+	
+	def record(self, new_count, capacity, min_spacing=0):
+		"""
+		Records the result of a poll and schedules the next one.
+		`capacity` is how many items a poll can return before things start
+		being missed, `min_spacing` is the least time the rate limit allows.
+		"""
+		old_interval = self.interval
+		if new_count >= capacity * self.busy_ratio:
+			self.interval *= self.speedup
+		elif new_count == 0:
+			self.interval *= self.slowdown
+		self.interval = min(max(self.interval, self.min_interval), self.max_interval)
+		
+		if self.interval != old_interval:
+			logging.debug("Polling {} every {:.0f}s".format(self.name, self.interval))
+		self.next_poll = time() + max(self.interval, min_spacing)
+
+def next_poll(pollers):
+	return min(p.next_poll for p in pollers)
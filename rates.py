@@ -0,0 +1,135 @@
+from collections import OrderedDict
+from array import array
+from time import time
+from urllib.parse import urlparse
+import zlib
+from cache import Cache
+
+class _RingCounter:
+	"""
+	Per-key counts for the last n buckets of a sliding window.
+	"""
+	
+	def __init__(self, buckets, since):
+		self.since = since
+		self.counts = array("I", [0] * buckets)
+		self.epochs = array("q", [-1] * buckets)
+	
+	def add(self, epoch, count):
+		i = epoch % len(self.counts)
+		if self.epochs[i] > epoch:
+			return
+		if self.epochs[i] != epoch:
+			self.epochs[i] = epoch
+			self.counts[i] = 0
+		self.counts[i] += count
+	
+	def total(self, first_epoch, last_epoch):
+		return sum(c for c, e in zip(self.counts, self.epochs) if first_epoch <= e <= last_epoch)
+
+class _CountMinSketch:
+	"""
+	Fixed-size approximate counter. Estimates never undercount.
+	"""
+	
+	def __init__(self, width, depth):
+		self.width = width
+		self.depth = depth
+		self.table = array("I", [0] * (width * depth))
+	
+	def _cells(self, key):
+		data = key.encode("utf-8")
+		return [row * self.width + zlib.crc32(data, row) % self.width for row in range(self.depth)]
+	
+	def add(self, key, count):
+		for cell in self._cells(key):
+			self.table[cell] += count
+	
+	def estimate(self, key):
+		return min(self.table[cell] for cell in self._cells(key))
+	
+	def clear(self):
+		for i in range(len(self.table)):
+			self.table[i] = 0
+
+class RateTracker(Cache):
+	"""
+	Sliding-window counts of events per key (authors, domains, ...). The most
+	recently seen keys are counted exactly, everything else falls back to a
+	ring of count-min sketches, so memory stays fixed however many keys show up.
+	Events are counted at the time they happened, which may be out of order;
+	those older than the window already kept are dropped.
+	"""
+	
+	def __init__(self, bucket_seconds=60, buckets=60, max_keys=2000, width=512, depth=4, file=None):
+		super().__init__(file)
+		
+		self.bucket_seconds = bucket_seconds
+		self.buckets = buckets
+		self.max_keys = max_keys
+		
+		self._exact = OrderedDict()
+		self._sketches = [_CountMinSketch(width, depth) for n in range(buckets)]
+		self._sketch_epochs = [-1] * buckets
+	
+	@property
+	def max_window(self):
+		return self.bucket_seconds * self.buckets
+	
+	def _epoch(self, when):
+		return int(when // self.bucket_seconds)
+	
+	def add(self, key, count=1, when=None):
+		epoch = self._epoch(when or time())
+		
+		# Long tail
+		i = epoch % self.buckets
+		if self._sketch_epochs[i] > epoch:
+			return
+		if self._sketch_epochs[i] != epoch:
+			self._sketch_epochs[i] = epoch
+			self._sketches[i].clear()
+		self._sketches[i].add(key, count)
+		
+		# Recent keys
+		counter = self._exact.get(key)
+		if counter is None:
+			counter = _RingCounter(self.buckets, epoch)
+			self._exact[key] = counter
+			if len(self._exact) > self.max_keys:
+				self._exact.popitem(last=False)
+		else:
+			self._exact.move_to_end(key)
+		counter.add(epoch, count)
+	
+	def count(self, key, window, now=None):
+		"""
+		Number of events for the key in the last `window` seconds, rounded up to
+		whole buckets (plus the current partial one) and capped at max_window.
+		"""
+		last_epoch = self._epoch(now or time())
+		first_epoch = last_epoch - min(int(-(-window // self.bucket_seconds)), self.buckets - 1)
+		
+		# Keys only count exactly since they were last (re)added to the exact set
+		counter = self._exact.get(key)
+		if counter is not None and counter.since <= first_epoch:
+			return counter.total(first_epoch, last_epoch)
+		return sum(sketch.estimate(key) for sketch, epoch in zip(self._sketches, self._sketch_epochs)
+				   if first_epoch <= epoch <= last_epoch)
+	
+	def data(self):
+		return self._exact
+	
+	def __iter__(self):
+		return self._exact.__iter__()
+
+def link_domain(link):
+	if not "://" in link:
+		link = "http://"+link
+	try:
+		domain = urlparse(link).netloc.lower()
+	except ValueError:
+		return None
+	if domain.startswith("www."):
+		domain = domain[4:]
+	return domain or None
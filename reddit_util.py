@@ -1,34 +1,40 @@
-import praw, requests
-from requests.auth import HTTPBasicAuth
-import re
-from time import time
+import re, json
+from time import time, sleep
+from threading import RLock
+from logging import debug, info, warning, error, exception
+from guard import RetryLater
+from things import Thing
 
 # Initialization
 
+session = None		# Current reddit session, used to act on thing snapshots by fullname
+
 _oauth_scopes = {"identity", "edit", "modposts", "modwiki", "privatemessages", "read", "report", "wikiread", "submit", "modcontributors"}
 _oauth_start = 0
 _oauth_length = 3300
+_oauth_token = None
 
 def init_reddit_session():
-	global _oauth_start, _oauth_length
+	global _oauth_start, _oauth_length, _oauth_token
 	
 	try:
-		import config
+		import config, praw, requests
+		from requests.auth import HTTPBasicAuth
 		
-		print("Connecting to reddit...", end=" ")
+		info("Connecting to reddit")
 		r = praw.Reddit(user_agent=config.useragent)
 		
-		print("logging in...", end=" ")
+		debug("Logging in")
 		if config.username is None or config.password is None:
 			return None
 		
 		client_auth = HTTPBasicAuth(config.oauth_id, config.oauth_secret)
 		headers = {"User-Agent": config.useragent}
 		data = {"grant_type": "password", "username": config.username, "password": config.password}
-		response = requests.post("https://www.reddit.com/api/v1/access_token", auth=client_auth, headers=headers, data=data)
+		response = requests.post(config.reddit_auth_url, auth=client_auth, headers=headers, data=data)
 		response_content = response.json()
 		if "error" in response_content and response_content["error"] != 200:
-			print("failed!\nResponse code = {}".format(response_content["error"]))
+			error("Failed to log in, response code = {}".format(response_content["error"]))
 			return None
 		
 		token = response_content["access_token"]
@@ -36,51 +42,216 @@ def init_reddit_session():
 			return None
 		_oauth_start = time()
 		_oauth_length = response_content["expires_in"] - 300
-		r.set_oauth_app_info(config.oauth_id, config.oauth_secret, "http://example.com/unused/redirect/uri")
-		r.set_access_credentials(_oauth_scopes, access_token=token)
-		r.config.api_request_delay = 1
+		_oauth_token = token
+		_authorize(r, token)
 		
-		print("done!")
+		info("Connected to reddit")
 		return r
 	
 	except Exception as e:
-		print("failed! Couldn't connect: {}".format(e))
+		error("Couldn't connect to reddit: {}".format(e))
 		raise e
 
+def resume_reddit_session(state):
+	"""
+	Reuses the token from a previous session state if it's still valid,
+	otherwise logs in again.
+	"""
+	global _oauth_start, _oauth_length, _oauth_token
+	
+	if state is None or time() - state["start"] >= state["length"]:
+		return init_reddit_session()
+	
+	import config, praw
+	
+	debug("Reusing oauth token")
+	r = praw.Reddit(user_agent=config.useragent)
+	_oauth_start = state["start"]
+	_oauth_length = state["length"]
+	_oauth_token = state["token"]
+	_authorize(r, _oauth_token)
+	return r
+
+def get_session_state():
+	if _oauth_token is None:
+		return None
+	return {"token": _oauth_token, "start": _oauth_start, "length": _oauth_length}
+
+def _authorize(r, token):
+	global session
+	import config
+	
+	session = r
+	# Setting credentials already makes requests, so the API URL goes first
+	if config.reddit_oauth_url is not None:
+		r.config.oauth_url = config.reddit_oauth_url
+	r.set_oauth_app_info(config.oauth_id, config.oauth_secret, "http://example.com/unused/redirect/uri")
+	r.set_access_credentials(_oauth_scopes, access_token=token)
+	r.config.api_request_delay = config.reddit_request_delay
+	r.http.hooks["response"].append(_track_ratelimit)
+
 def destroy_reddit_session(r):
 	r.clear_authentication()
 
 def renew_reddit_session(r):
 	if time() - _oauth_start >= _oauth_length:
-		print("Renewing oauth token")
+		info("Renewing oauth token")
 		return init_reddit_session()
 	return r
 
-# Thing getting
+# Rate limits
 
-_last_new_time = -1
+# Remaining requests (negative until a response reports them), reset time and
+# limit. Kept in one array so worker processes can share the main process's.
+_ratelimit = [-1.0, 0.0, 600.0]
+_ratelimit_lock = RLock()
 
-def get_all_new(subreddit, limit=200, save_last=True):
-	global _last_new_time
-	posts = []
+def share_ratelimit(shared=None):
+	"""
+	Moves the rate limit state into shared memory, or adopts state shared by
+	the main process. Returns the shared state to hand to worker processes.
+	"""
+	global _ratelimit, _ratelimit_lock
+	import multiprocessing
+	
+	if shared is None:
+		shared = multiprocessing.get_context("spawn").Array("d", list(_ratelimit))
+	_ratelimit = shared
+	_ratelimit_lock = shared.get_lock()
+	return shared
+
+def _track_ratelimit(response, *args, **kwargs):
+	headers = response.headers
+	if "x-ratelimit-remaining" in headers and "x-ratelimit-reset" in headers:
+		try:
+			remaining = float(headers["x-ratelimit-remaining"])
+			reset = time() + float(headers["x-ratelimit-reset"])
+			used = float(headers["x-ratelimit-used"]) if "x-ratelimit-used" in headers else None
+		except ValueError:
+			return
+		with _ratelimit_lock:
+			_ratelimit[0] = remaining
+			_ratelimit[1] = reset
+			if used is not None:
+				_ratelimit[2] = remaining + used
+
+def get_ratelimit():
+	"""
+	Returns the remaining number of requests and seconds until the rate limit
+	resets, or (None, 0) if no rate limit has been seen yet.
+	"""
+	with _ratelimit_lock:
+		remaining, reset = _ratelimit[0], _ratelimit[1]
+	if remaining < 0 or time() >= reset:
+		return None, 0
+	return remaining, reset - time()
+
+def ratelimit_spacing(calls):
+	"""
+	Seconds to wait before making `calls` more requests so the remaining budget
+	lasts until the rate limit resets.
+	"""
+	remaining, reset = get_ratelimit()
+	if remaining is None:
+		return 0
+	return reset * calls / max(remaining, 1)
+
+# Request budget
+# Everything shares one rate limit, so less important calls stop once the
+# remaining budget drops to the share kept back for more important ones.
+
+PRIORITY_ACTION = 0			# Removals, bans, replies and other moderation actions
+PRIORITY_LISTING = 1		# New posts, comments and messages
+PRIORITY_HISTORY = 2		# User history lookups
+PRIORITY_LOGGING = 3		# Log subreddit posts
+
+_reserves = {
+	PRIORITY_ACTION: 0,
+	PRIORITY_LISTING: 0.05,
+	PRIORITY_HISTORY: 0.2,
+	PRIORITY_LOGGING: 0.3
+}
+
+def has_budget(priority, calls=1):
+	remaining, reset = get_ratelimit()
+	if remaining is None:
+		return True
+	return remaining - calls >= _reserves[priority] * _ratelimit[2]
+
+def acquire(priority, calls=1):
+	"""
+	Claims budget for calls at the given priority. Moderation actions wait for
+	the rate limit to reset if the budget is exhausted and the reset is close,
+	anything else raises RetryLater when the budget is down to the reserve for
+	higher priorities.
+	"""
+	import config
+	
+	if not has_budget(priority, calls):
+		remaining, reset = get_ratelimit()
+		if priority != PRIORITY_ACTION or reset > config.action_max_wait:
+			raise RetryLater("Not enough request budget for priority {}".format(priority))
+		warning("Request budget exhausted, waiting {:.0f}s".format(reset))
+		sleep(reset)
+	
+	# Claimed until the next response says otherwise
+	with _ratelimit_lock:
+		if _ratelimit[0] >= 0:
+			_ratelimit[0] = max(_ratelimit[0] - calls, 0)
+
+# Thing getting
+
+def _get_listing(r, path, limit, full_page, last_time=None):
+	"""
+	Pages through a listing as thing snapshots until the limit, a short page,
+	or a thing older than last_time.
+	"""
+	things = []
 	
 	after = None
-	while len(posts) < limit:
-		new_posts = list(subreddit.get_new(limit=100, params={"after": after}))
-		if len(new_posts) == 0:
+	while len(things) < limit:
+		page, after = get_listing_page(r, path, after)
+		if len(page) == 0:
 			break
 		
-		posts.extend(new_posts)
-		after = "t3_"+posts[-1].id
-		after_time = posts[-1].created_utc
+		things.extend(page)
+		after = things[-1].fullname
+		after_time = things[-1].created_utc
 		
-		if len(new_posts) < 50 or (save_last and after_time < _last_new_time):
+		if len(page) < full_page or (last_time is not None and after_time < last_time):
 			break
 	
+	return things
+
+def get_listing_page(r, path, after=None):
+	"""
+	Returns one page of a listing as thing snapshots, and the fullname to get
+	the next page after (None at the end of the listing).
+	"""
+	response = r.request_json(r.config.oauth_url+path, params={"limit": 100, "after": after, "raw_json": 1}, as_objects=False)
+	things = [Thing.from_json(child) for child in response["data"]["children"]]
+	return things, response["data"].get("after")
+
+_last_new_time = -1
+
+def get_all_new(r, subreddit_name, limit=200, save_last=True):
+	global _last_new_time
+	
+	posts = _get_listing(r, "/r/{}/new".format(subreddit_name), limit, 50, _last_new_time if save_last else None)
 	if save_last and len(posts) > 0:
 		_last_new_time = posts[0].created_utc
 	return posts
 
+_last_new_comment_time = -1
+
+def get_new_comments(r, subreddit_name, limit=300, save_last=True):
+	global _last_new_comment_time
+	
+	comments = _get_listing(r, "/r/{}/comments".format(subreddit_name), limit, 100, _last_new_comment_time if save_last else None)
+	if save_last and len(comments) > 0:
+		_last_new_comment_time = comments[0].created_utc
+	return comments
+
 _last_comment_time = -1
 
 def get_all_comments(subreddit_or_user, limit=300, save_last=True):
@@ -127,8 +298,84 @@ def get_all_submitted(user, limit=200, save_last=True):
 		_last_submitted_time = posts[0].created_utc
 	return posts
 
+def get_things(r, fullnames):
+	"""
+	Fetches snapshots of things by fullname, up to 100 per request. Returns a
+	dict of fullname to thing, things that no longer exist are missing.
+	"""
+	things = {}
+	fullnames = list(fullnames)
+	for i in range(0, len(fullnames), 100):
+		response = r.request_json(r.config.oauth_url+"/api/info",
+								  params={"id": ",".join(fullnames[i:i+100]), "raw_json": 1}, as_objects=False)
+		for child in response["data"]["children"]:
+			thing = Thing.from_json(child)
+			things[thing.fullname] = thing
+	return things
+
+def revalidate(r, fullnames, exclude=None):
+	"""
+	Fetches fresh copies of things like get_things, dropping those that were
+	deleted, removed, or match the optional exclude function.
+	"""
+	things = get_things(r, fullnames)
+	return {fullname: thing for fullname, thing in things.items()
+			if is_live(thing) and (exclude is None or not exclude(thing))}
+
+def is_live(thing):
+	"""
+	Whether a thing is still up, i.e. not deleted by its author or removed.
+	"""
+	if getattr(thing, "author", None) is None or getattr(thing, "banned_by", None):
+		return False
+	text = getattr(thing, "body", None) or getattr(thing, "selftext", None)
+	return not text in ("[deleted]", "[removed]")
+
+def get_redditor(r, user_name):
+	return r.get_redditor(user_name, fetch=False)
+
+def get_moderators(r, subreddit_name):
+	return frozenset(mod.name.lower() for mod in r.get_moderators(subreddit_name))
+
+_wiki_validators = None
+
 def get_wiki_page(r, subreddit_name, page_name):
-	return r.get_wiki_page(subreddit_name, page_name)
+	"""
+	Returns the markdown content of a wiki page, or None if it can't be fetched.
+	Unchanged pages aren't downloaded again.
+	"""
+	global _wiki_validators
+	import config, http_util
+	from cache import open_obj_cache
+	
+	if _wiki_validators is None:
+		_wiki_validators = open_obj_cache("wiki", 604800)
+	
+	url = "{}/r/{}/wiki/{}".format(r.config.oauth_url, subreddit_name, page_name)
+	headers = {"Authorization": "bearer "+str(_oauth_token), "User-Agent": config.useragent}
+	try:
+		status, body = http_util.conditional_get(r.http, url, _wiki_validators, headers=headers, params={"raw_json": 1})
+		if status == 200:
+			return json.loads(body)["data"]["content_md"]
+		warning("Failed to get wiki page ({})".format(status))
+	except Exception as e:
+		warning("Failed to get wiki page: {}".format(e))
+	return None
+
+def get_wiki_revision(r, subreddit_name, page_name):
+	"""
+	Returns the ID of the latest revision of a wiki page, or None if unknown.
+	Much cheaper than fetching and parsing the page itself.
+	"""
+	url = "{}/r/{}/wiki/revisions/{}".format(r.config.oauth_url, subreddit_name, page_name)
+	try:
+		response = r.request_json(url, params={"limit": 1}, as_objects=False)
+		revisions = response["data"]["children"]
+		if len(revisions) > 0:
+			return revisions[0]["id"]
+	except Exception as e:
+		warning("Failed to get wiki revision: {}".format(e))
+	return None
 
 # Thing doing
 
@@ -146,15 +393,14 @@ def comment_on(comment_text, post=None, comment=None, distinguish=False):
 	if distinguish and reply is not None:
 		response = reply.distinguish()
 		if len(response) > 0 and len(response["errors"]) > 0:
-			print("Error when distinguishing: {0}".format(response["errors"]))
+			warning("Error when distinguishing: {0}".format(response["errors"]))
 
 def submit_text_post(r, subreddit, title, body):
 	try:
 		r.submit(subreddit, title, text=body, send_replies=False)
 	except Exception as e:
-		print("!!! Error when submitting text post")
-		print(e)
-		print(vars(e))
+		error("Error when submitting text post ({})".format(e))
+		exception(e)
 
 def send_modmail(r, subreddit, title, body):
 	r.send_message("/r/"+subreddit, title, body)
@@ -163,6 +409,12 @@ def send_pm(r, user, title, body, from_sr=None):
 	r.send_message(user, title, body, from_sr=from_sr)
 
 def reply_to(thing, body, distinguish=False):
+	import praw
+	
+	if isinstance(thing, Thing):
+		_reply_by_fullname(session, thing.fullname, body, distinguish)
+		return
+	
 	reply = None
 	if isinstance(thing, praw.objects.Submission):
 		reply = thing.add_comment(body)
@@ -172,10 +424,40 @@ def reply_to(thing, body, distinguish=False):
 	if distinguish and reply is not None:
 		response = reply.distinguish()
 		if len(response) > 0 and len(response["errors"]) > 0:
-			print("Error when distinguishing: {0}".format(response["errors"]))
+			warning("Error when distinguishing: {0}".format(response["errors"]))
+
+def _reply_by_fullname(r, fullname, body, distinguish=False):
+	response = _api(r, "/api/comment", {"thing_id": fullname, "text": body})
+	things = response.get("json", {}).get("data", {}).get("things", [])
+	if distinguish and len(things) > 0:
+		response = _api(r, "/api/distinguish", {"id": things[0]["data"]["name"], "how": "yes"})
+		errors = response.get("json", {}).get("errors", [])
+		if len(errors) > 0:
+			warning("Error when distinguishing: {0}".format(errors))
+
+def remove(r, fullname, spam=False):
+	_api(r, "/api/remove", {"id": fullname, "spam": spam})
+
+def report(r, fullname, reason=None):
+	_api(r, "/api/report", {"thing_id": fullname, "reason": reason or ""})
 
-def set_flair(r, subreddit, thing, flair_text, flair_css):
-	r.set_flair()
+def ban_user(r, subreddit, user_name, note=None, message=None, duration=0):
+	r.get_subreddit(subreddit).add_ban(user_name, params={"note": note, "ban_message": message, "duration": duration})
+
+def set_flair(r, subreddit, item, flair_text, flair_css):
+	"""
+	Sets the flair of a post, or of a user given a user or user name.
+	"""
+	data = {"text": flair_text or "", "css_class": flair_css or ""}
+	if is_post(item):
+		data["link"] = item.fullname
+	else:
+		data["name"] = str(getattr(item, "name", item))
+	_api(r, "/r/{}/api/flair".format(subreddit), data)
+
+def _api(r, path, data):
+	data = dict(data, api_type="json")
+	return r.request_json(r.config.oauth_url+path, data=data, as_objects=False)
 
 # Utilities
 
@@ -200,11 +482,22 @@ def reduce_reddit_link(link, include_prefix=False):
 	
 	return link
 
+# praw is imported lazily so the bot can start (and list filters) without it
+
 def is_post(thing):
+	if isinstance(thing, Thing):
+		return thing.is_post
+	import praw
 	return isinstance(thing, praw.objects.Submission)
 
 def is_comment(thing):
+	if isinstance(thing, Thing):
+		return thing.is_comment
+	import praw
 	return isinstance(thing, praw.objects.Comment)
 
 def is_message(thing):
+	if isinstance(thing, Thing):
+		return False
+	import praw
 	return isinstance(thing, praw.objects.Message)
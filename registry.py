@@ -0,0 +1,42 @@
+from collections import namedtuple, OrderedDict
+import importlib, glob, os
+
+# Lightweight filter registry, importable without pulling in any filter
+# (or praw, yaml, requests) so the core can list and select filters cheaply.
+
+FilterEntry = namedtuple("FilterEntry", ["filter_id", "module", "class_name", "types", "name", "descr", "author"])
+
+_entries = OrderedDict()
+_manifests = set()
+
+def register(filter_id, module, class_name, types=(), name=None, descr=None, author=None):
+	"""
+	Registers a filter class without importing it. Called from the manifest
+	in the filter package's __init__.py.
+	"""
+	_entries[filter_id] = FilterEntry(filter_id, module, class_name, tuple(types), name, descr, author)
+
+def load_manifest(package):
+	if package not in _manifests:
+		importlib.import_module(package)
+		_manifests.add(package)
+	return list(_entries.values())
+
+def get_entry(filter_id):
+	return _entries.get(filter_id)
+
+def load_class(package, entry):
+	module = importlib.import_module(package+"."+entry.module)
+	return getattr(module, entry.class_name)
+
+def unlisted_modules(package):
+	"""
+	Filter modules in the package directory that no manifest entry refers to.
+	"""
+	listed = set(entry.module for entry in _entries.values())
+	modules = []
+	for file in sorted(glob.glob(package+"/*.py")):
+		name = os.path.splitext(os.path.basename(file))[0]
+		if not name.startswith("__") and name not in listed:
+			modules.append(name)
+	return modules
@@ -0,0 +1,68 @@
+from time import time
+from logging import debug, warning
+import pickle
+from cache import Cache
+
+class Snapshot(Cache):
+	"""
+	Warm state kept between --once runs: the reddit session token, the wiki
+	config and the configured state of each filter. Post, comment, job and
+	rate caches are saved to their own files as usual.
+	"""
+	
+	def __init__(self, file=None):
+		super().__init__(file)
+		
+		self.saved_at = 0
+		self.session = None
+		self.config_revision = None
+		self.last_config_check = 0
+		self.filter_configs = None
+		self.filter_states = {}
+	
+	def capture_filters(self, filters, config_hashes):
+		"""
+		Stores the configured state of each filter with the hash of the config
+		it was built from. Filters whose state can't be pickled are left out
+		and will be configured from scratch on the next run.
+		"""
+		self.filter_states = {}
+		for f in filters:
+			f_hash = config_hashes.get(f.filter_id)
+			if f_hash is None:
+				continue
+			state = {k: v for k, v in vars(f).items() if not k in ("jobs", "rates")}
+			try:
+				pickle.dumps(state)
+			except Exception as e:
+				debug("Can't snapshot filter {} ({})".format(f.filter_id, e))
+				continue
+			self.filter_states[f.filter_id] = (f_hash, state)
+	
+	def restore_filters(self, filters, config_hashes):
+		"""
+		Restores captured filter state. Restored filters are marked as
+		configured, so applying the same config again leaves them alone and
+		only filters whose config changed are configured again. Filters have
+		to keep their configured state on the instance for this to work.
+		"""
+		for f in filters:
+			if not f.filter_id in self.filter_states:
+				continue
+			f_hash, state = self.filter_states[f.filter_id]
+			try:
+				vars(f).update(state)
+			except Exception as e:
+				warning("Failed to restore filter {} ({})".format(f.filter_id, e))
+				continue
+			config_hashes[f.filter_id] = f_hash
+	
+	def save(self):
+		self.saved_at = time()
+		super().save()
+	
+	def data(self):
+		return self.filter_states
+	
+	def __iter__(self):
+		return self.filter_states.__iter__()
@@ -1,13 +1,25 @@
 #!/usr/bin/env python3
 from abc import ABCMeta, abstractmethod
+from collections import ChainMap, deque
+from collections.abc import Mapping
 from enum import IntEnum
-from requests import HTTPError
-import os, sys, yaml, re, traceback, inspect
+from functools import lru_cache
+import os, sys, traceback, inspect, hashlib
 from threading import Thread, Event
-from praw.errors import ModeratorRequired, ModeratorOrScopeRequired
+from queue import Queue
+from time import time
 
-import config, reddit_util
-from cache import load_cached_storage
+import config, reddit_util, registry, polling, http_util, text_util
+from text_util import Template
+from cache import load_cached_storage, open_thing_cache
+from jobs import JobQueue
+from rates import RateTracker, link_domain
+from guard import FilterGuard, FilterTimeout, CircuitOpen, RetryLater
+from log_util import thing_fields
+from snapshot import Snapshot
+from journal import ActionJournal
+from backfill import Backfill, Watermarks
+from ordering import FilterStats
 
 import warnings
 warnings.simplefilter("ignore", ResourceWarning)
@@ -29,24 +41,29 @@ r = None
 def build_local_config():
 	config.subreddit = config.subreddit.lower()
 	config.user_whitelist = [s.lower() for s in config.config_whitelist]
-	config.submitter_blacklist = [s.lower() for s in config.submitter_blacklist]
+	config.submitter_blacklist = frozenset(s.lower() for s in config.submitter_blacklist)
+	config.trusted_users = frozenset(s.lower() for s in config.trusted_users)
 	if not config.username or not config.password or not config.oauth_id or not config.oauth_secret:
 		raise ValueError("All authentication parameters must be specified")
 	config.username = config.username.lower()
 
 def build_remote_config():
+	import yaml
+	
 	wiki_config = reddit_util.get_wiki_page(r, config.config_subreddit, config.config_page)
 	if not wiki_config:
-		print("Error: wiki page doesn't exist")
+		error("Wiki page doesn't exist")
 		return None
 	
 	try:
-		parsed = yaml.safe_load_all(wiki_config.content_md)
+		# Use the C (libyaml) loader when PyYAML was built with it
+		loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+		parsed = yaml.load_all(wiki_config, Loader=loader)
 		
 		config_groups = {}
 		for i, group in enumerate(parsed):
 			if not "filter" in group:
-				print("Warning: config {} not associated with filter".format(i+1))
+				warning("Config {} not associated with filter".format(i+1))
 				continue
 			filter_id = group["filter"]
 			del group["filter"]
@@ -58,38 +75,74 @@ def build_remote_config():
 		return config_groups
 		
 	except (yaml.YAMLError, KeyError) as e:
-		print("Error: failed to parse config, {}".format(e))
+		error("Failed to parse config, {}".format(e))
 		return None
 
-def get_filters():
-	import os, glob
+def hash_filter_config(f_configs):
+	import hashlib, json
+	
+	dumped = json.dumps(f_configs, sort_keys=True, default=str)
+	return hashlib.sha1(dumped.encode("utf-8")).hexdigest()
+
+def get_filters(filter_ids=None):
+	"""
+	Returns the filter classes for the given filter IDs, or all filters if None.
+	Registered filters are imported directly from the manifest, only modules
+	missing from the manifest are imported and scanned.
+	"""
 	import importlib
 	
 	filters = []
-	files = glob.glob(config.filter_location+"/*.py")
-	for file in files:
-		name = os.path.splitext(os.path.basename(file))[0]
-		module = importlib.import_module(config.filter_location+"." + name)
-		for member in dir(module):
-			if member.startswith("__") \
-					or member == "Filter" \
-					or member == "LinkFilter" \
-					or member == "PostFilter" \
-					or member == "CommentFilter":
-				continue
-			
-			member_class = getattr(module, member)
-			if inspect.isclass(member_class):
-				try:
-					# Nasty workaround since a Filter imported into another module is different from the one used here
-					if fake_isinstance(member_class, Filter):
-						filters.append(member_class)
-				except TypeError:
-					# Not-so-neat way of avoiding uninitializable types with no built-in type checks, like enum
-					pass
+	missing = None if filter_ids is None else set(filter_ids)
+	for entry in registry.load_manifest(config.filter_location):
+		if filter_ids is None or entry.filter_id in filter_ids:
+			filters.append(registry.load_class(config.filter_location, entry))
+			if missing is not None:
+				missing.discard(entry.filter_id)
+	
+	if missing is None or len(missing) > 0:
+		for name in registry.unlisted_modules(config.filter_location):
+			module = importlib.import_module(config.filter_location+"." + name)
+			for filter_class in _scan_filter_module(module):
+				if filter_ids is None or filter_class.filter_id in filter_ids:
+					filters.append(filter_class)
 	
 	return filters
 
+def _scan_filter_module(module):
+	filters = []
+	for member in dir(module):
+		if member.startswith("__") \
+				or member == "Filter" \
+				or member == "LinkFilter" \
+				or member == "PostFilter" \
+				or member == "CommentFilter" \
+				or member == "MessageFilter":
+			continue
+		
+		member_class = getattr(module, member)
+		if inspect.isclass(member_class):
+			try:
+				# Nasty workaround since a Filter imported into another module is different from the one used here
+				if fake_isinstance(member_class, Filter):
+					filters.append(member_class)
+			except TypeError:
+				# Not-so-neat way of avoiding uninitializable types with no built-in type checks, like enum
+				pass
+	return filters
+
+def list_filters():
+	import importlib
+	
+	entries = registry.load_manifest(config.filter_location)
+	for name in registry.unlisted_modules(config.filter_location):
+		module = importlib.import_module(config.filter_location+"." + name)
+		for f in _scan_filter_module(module):
+			types = [t for t, c in (("link", LinkFilter), ("post", PostFilter), ("comment", CommentFilter), ("message", MessageFilter)) if fake_isinstance(f, c)]
+			entries.append(registry.FilterEntry(f.filter_id, name, f.__name__, tuple(types),
+				getattr(f, "filter_name", None), getattr(f, "filter_descr", None), getattr(f, "filter_author", None)))
+	return entries
+
 ###########
 # Filters #
 ###########
@@ -97,6 +150,9 @@ def get_filters():
 class Filter(metaclass=ABCMeta):
 	filter_id = None
 	enabled = True
+	jobs = None
+	rates = None			# Sliding-window counts keyed by "author:<name>" and "domain:<domain>"
+	shared_state = False	# Keeps state across authors, so it always runs in the main process
 	
 	@abstractmethod
 	def init_filter(self, configs):
@@ -104,6 +160,22 @@ class Filter(metaclass=ABCMeta):
 	
 	def update(self):
 		yield False
+	
+	def schedule(self, thing, delay, payload=None, max_attempts=20):
+		"""
+		Asks for process_job to be called with a fresh copy of the thing after
+		delay seconds. Pending jobs survive restarts, so payloads must be small
+		and picklable. Scheduling the same thing twice does nothing.
+		"""
+		key = self.filter_id+":"+thing.fullname
+		return self.jobs.submit(self.filter_id, key, thing.fullname, delay, payload, max_attempts)
+	
+	def process_job(self, job, thing):
+		"""
+		Called when a scheduled job is due. Returns a filter result like the
+		process methods. Call self.jobs.retry(job) to try again later.
+		"""
+		return False
 
 class FilterResult(IntEnum):
 	BAN = 1
@@ -142,13 +214,22 @@ link_filters = []
 post_filters = []
 comment_filters = []
 pm_filters = []
+filter_guards = {}
+job_queue = None
+rate_tracker = None
+filter_stats = None
+action_journal = None
+
+config_revision = None
+config_hashes = {}
+filter_configs = None
 
-def init_filters(configure=True):
+def init_filters(configure=True, force=False):
 	info("Loading filters...")
 	
 	# Load filters if not already loaded
 	if len(all_filters) == 0:
-		new_filters = get_filters()
+		new_filters = get_filters(config.enabled_filters)
 		info("using {} filters...".format(len(new_filters)))
 		
 		for nf_class in new_filters:
@@ -157,38 +238,83 @@ def init_filters(configure=True):
 				continue
 			if nf_class.filter_id in config.enabled_filters:
 				nf = nf_class()
+				nf.jobs = job_queue
+				nf.rates = rate_tracker
 				all_filters.append(nf)
+				filter_guards[nf.filter_id] = FilterGuard(nf.filter_id,
+					budget=config.filter_time_budget,
+					max_failures=config.filter_max_failures,
+					cooldown=config.filter_cooldown)
 				if fake_isinstance(nf_class, LinkFilter):
 					link_filters.append(nf)
 				if fake_isinstance(nf_class, PostFilter):
 					post_filters.append(nf)
 				if fake_isinstance(nf_class, CommentFilter):
 					comment_filters.append(nf)
+				if fake_isinstance(nf_class, MessageFilter):
+					pm_filters.append(nf)
 	
 	# Initialize filters with wiki config
+	configs = None
 	if configure:
-		info("configuring filters...")
-		configs = build_remote_config()
-		for f in all_filters:
-			debug("Configuring {}".format(f.filter_id))
-			debug("--------------------")
-			
-			f_configs = configs[f.filter_id] if f.filter_id in configs else []
-			try:
-				f.enabled = True
-				filter_error = f.init_filter(f_configs)
-				if filter_error:
-					error("Filter configuration failed for {} ({})\n".format(f.filter_id, filter_error))
-					f.enabled = False
-			except Exception as e:
-				ex_type, ex, tb = sys.exc_info()
-				error("Filter configuration unexpectedly failed for {} ({})".format(f.filter_id, e))
-				traceback.print_tb(tb)
-				del tb
-			
-		debug("--------------------")
+		configs = configure_filters(force)
+		if configs is not None:
+			refresh_moderators()
 	
 	info("done!")
+	return configs
+
+def configure_filters(force=False):
+	"""
+	Reconfigures filters from the wiki. The page is only fetched if its revision
+	changed (or if forced), and only filters whose config changed are
+	reinitialized so the others keep their state.
+	Returns the new config groups, or None if nothing was reloaded.
+	"""
+	global config_revision
+	
+	revision = reddit_util.get_wiki_revision(r, config.config_subreddit, config.config_page)
+	if not force and revision is not None and revision == config_revision:
+		debug("Config unchanged (revision {})".format(revision))
+		return None
+	
+	info("configuring filters...")
+	configs = build_remote_config()
+	if configs is None:
+		return None
+	config_revision = revision
+	
+	apply_filter_configs(configs)
+	return configs
+
+def apply_filter_configs(configs):
+	global filter_configs
+	filter_configs = configs
+	
+	for f in all_filters:
+		f_configs = configs[f.filter_id] if f.filter_id in configs else []
+		f_hash = hash_filter_config(f_configs)
+		if config_hashes.get(f.filter_id) == f_hash:
+			debug("Config unchanged for {}".format(f.filter_id))
+			continue
+		
+		debug("Configuring {}".format(f.filter_id))
+		debug("--------------------")
+		
+		config_hashes.pop(f.filter_id, None)
+		try:
+			f.enabled = True
+			filter_error = f.init_filter(f_configs)
+			if filter_error:
+				error("Filter configuration failed for {} ({})\n".format(f.filter_id, filter_error))
+				f.enabled = False
+			else:
+				config_hashes[f.filter_id] = f_hash
+		except Exception as e:
+			error("Filter configuration unexpectedly failed for {} ({})".format(f.filter_id, e), extra=thing_fields(filter_id=f.filter_id))
+			exception(e)
+	
+	debug("--------------------")
 
 def has_link_filters():
 	return len(link_filters) > 0
@@ -205,16 +331,16 @@ def has_message_filters():
 # Processing
 
 def process_post(post):
-	if not has_post_filters() and not has_link_filters():
-		return False
-	
-	# Check post filters first
-	for f in post_filters:
-		results = f.process_post(post)
-		if process_filter_results(results, post):
-			return True
-	
-	# Link check
+	results = evaluate_post(post)
+	return process_filter_results(results, post)
+
+def evaluate_post(post, shared=None, results=False):
+	"""
+	Runs the post through the filters without acting on it. With worker
+	processes, workers run the filters without shared state (shared=False)
+	and the main process the rest (shared=True), given the worker's results.
+	Returns the most severe filter result, or False.
+	"""
 	links = []
 	
 	# Extract links if text post
@@ -225,69 +351,240 @@ def process_post(post):
 	elif not post.is_self:
 		links.append(post.url)
 	
+	track_rates(post, links)
+	
+	if _is_final(results) or should_skip(post) or (not has_post_filters() and not has_link_filters()):
+		return results
+	
+	# Check post filters first
+	best = results
+	for f in ordered_filters(_select(post_filters, shared), "process_post"):
+		best = _most_severe(best, run_filter(f, "process_post", post))
+		if _is_final(best):
+			return best
+	
 	# Process links
 	for link in links:
-		results = process_link(link, post)
-		if process_filter_results(results, post):
-			return True
+		best = _most_severe(best, process_link(link, post, shared))
+		if _is_final(best):
+			return best
 	
-	return False
+	return best
 
 def process_comment(comment):
-	if not has_comment_filters() and not has_link_filters():
-		return False
+	results = evaluate_comment(comment)
+	return process_filter_results(results, comment)
+
+def evaluate_comment(comment, shared=None, results=False):
+	"""
+	Runs the comment through the filters without acting on it, like
+	evaluate_post. Returns the most severe filter result, or False.
+	"""
+	# Extract links
+	links = extract_submission_links(comment.body)
+	
+	track_rates(comment, links)
+	
+	if _is_final(results) or should_skip(comment) or (not has_comment_filters() and not has_link_filters()):
+		return results
 	
 	# Check comment filters
-	for f in comment_filters:
-		results = f.process_comment(comment)
-		if process_filter_results(results, comment):
-			return True
+	best = results
+	for f in ordered_filters(_select(comment_filters, shared), "process_comment"):
+		best = _most_severe(best, run_filter(f, "process_comment", comment))
+		if _is_final(best):
+			return best
 	
-	# Link check
-	links = []
-
-	# Extract links
-	text = comment.body
-	links.extend(extract_submission_links(text))
-
 	# Process links
 	for link in links:
-		results = process_link(link, comment)
-		if process_filter_results(results, comment):
-			return True
+		best = _most_severe(best, process_link(link, comment, shared))
+		if _is_final(best):
+			return best
 	
-	return False
+	return best
 
-def process_link(link, thing):
-	for f in link_filters:
-		results = f.process_link(link, thing)
-		if results and results[0]:
-			return results
-	return False
+_moderators = frozenset()
+_moderators_time = 0
+
+def should_skip(thing):
+	"""
+	Cheap checks run before any filter: deleted, removed or approved things
+	and things by moderators, trusted users or blacklisted submitters.
+	"""
+	if not reddit_util.is_live(thing) or getattr(thing, "approved_by", None):
+		return True
+	
+	author = thing.author.name.lower()
+	return author in config.submitter_blacklist \
+		or author in config.trusted_users \
+		or author in get_moderators()
+
+def get_moderators():
+	if time() - _moderators_time >= config.moderator_cache_time:
+		refresh_moderators()
+	return _moderators
+
+def refresh_moderators():
+	global _moderators, _moderators_time
+	
+	try:
+		_moderators = reddit_util.get_moderators(r, config.subreddit)
+	except Exception as e:
+		warning("Failed to get moderators ({})".format(e))
+	_moderators_time = time()
+
+def track_rates(thing, links):
+	if rate_tracker is None:
+		return
+	# Counted when they were posted, so backfilled things don't look like a burst
+	when = getattr(thing, "created_utc", None)
+	if thing.author is not None:
+		rate_tracker.add("author:"+thing.author.name.lower(), when=when)
+	for domain in set(filter(None, map(link_domain, links))):
+		rate_tracker.add("domain:"+domain, when=when)
+
+def process_link(link, thing, shared=None):
+	best = False
+	for f in ordered_filters(_select(link_filters, shared), "process_link"):
+		best = _most_severe(best, run_filter(f, "process_link", link, thing))
+		if _is_final(best):
+			return best
+	return best
+
+def _select(filters, shared):
+	if shared is None:
+		return filters
+	return [f for f in filters if f.shared_state == shared]
+
+def ordered_filters(filters, method):
+	"""
+	Returns filters in the order to run them: pinned filters first, then the
+	rest by measured cost per removal. Evaluation only stops early once a
+	thing is being removed, so the order never lets a lesser result hide a
+	removal.
+	"""
+	if filter_stats is None:
+		return filters
+	return filter_stats.order(filters, method, config.filter_order)
 
 def process_message(message):
 	for f in pm_filters:
-		results = f.process_message(message)
+		results = run_filter(f, "process_message", message)
 		if process_filter_results(results, message):
 			return True
 	return False
 
-def process_filter_results(results, thing):
-	if results and len(results) == 2 and results[0]:
+def run_filter(f, method, *args):
+	"""
+	Calls a filter method under the filter's time budget and circuit breaker.
+	Things skipped because of a timeout or an open circuit are deferred and
+	re-evaluated by update_filters once the filter is available again.
+	"""
+	guard = filter_guards[f.filter_id]
+	thing = args[-1] if len(args) > 0 else None
+	start = time()
+	try:
+		results = guard.call(getattr(f, method), *args)
+		if filter_stats is not None:
+			filter_stats.record(f.filter_id, method, time() - start, _is_final(results))
+		debug("Filter {} ran {}".format(f.filter_id, method), extra=thing_fields(thing, f.filter_id, time() - start))
+		return results
+	except (FilterTimeout, CircuitOpen, RetryLater) as e:
+		# Open circuits and missing request budget say nothing about the filter's cost
+		if isinstance(e, FilterTimeout):
+			if filter_stats is not None:
+				filter_stats.record(f.filter_id, method, time() - start, False)
+			warning("Filter {} timed out, deferring".format(f.filter_id), extra=thing_fields(thing, f.filter_id, time() - start))
+		guard.defer(method, args)
+	except Exception as e:
+		if filter_stats is not None:
+			filter_stats.record(f.filter_id, method, time() - start, False)
+		error("Filter {} failed in {} ({})".format(f.filter_id, method, e), extra=thing_fields(thing, f.filter_id, time() - start))
+		exception(e)
+	return False
+
+def _most_severe(best, results):
+	if is_result(results) and (not is_result(best) or results[0] < best[0]):
+		return results
+	return best
+
+def _is_final(results):
+	# Nothing but a ban is more severe than removal
+	return is_result(results) and results[0] <= FilterResult.REMOVE
+
+def is_result(results):
+	return bool(results and len(results) == 2 and results[0])
+
+def process_filter_results(results, thing, only=None):
+	"""
+	Takes the actions for a filter result. Only the named action is taken if
+	`only` is given, as when a deferred action is retried.
+	"""
+	if is_result(results):
+		def perform(action, func, *args, **kwargs):
+			if only is None or only == action:
+				_perform(action, results, thing, func, *args, **kwargs)
+		
 		if results[0] <= FilterResult.BAN:
-			_ban_author(results[1], thing)
+			perform("ban", _ban_author, results[1], thing)
 		if results[0] <= FilterResult.REMOVE:
-			thing.remove()
+			perform("remove", thing.remove)
+		context = ThingContext(thing)
 		if results[0] <= FilterResult.MESSAGE:
-			_send_messages(results[1], thing)
-			_flair_thing(results[1], thing)
+			perform("message", _send_messages, results[1], thing, context)
+			perform("flair", _flair_thing, results[1], thing)
 		if results[0] <= FilterResult.LOG:
-			_log_result(results[1], thing)
+			perform("log", _log_result, results[1], context)
 		if results[0] == FilterResult.REPORT:
-			thing.report(reason=results[1])
+			perform("report", thing.report, reason=results[1])
 		return True
 	return False
 
+# Actions out of request budget are queued as jobs under this ID. Messages
+# can't be fetched again by fullname, so actions on them wait in memory.
+_action_jobs = "spamshark-actions"
+_deferred_actions = deque(maxlen=100)
+
+def _perform(action, results, thing, func, *args, **kwargs):
+	# Skip actions already taken on this thing, e.g. before a crash. A thing is
+	# only removed or banned once, but gets messages, flair, logs and reports
+	# for each different result.
+	fullname = getattr(thing, "fullname", None)
+	key = action if action in ("ban", "remove") else "{}:{}".format(action, _result_digest(results))
+	if action_journal is not None and fullname is not None and action_journal.has(fullname, key):
+		debug("Already performed {} on {}".format(action, fullname), extra=thing_fields(thing))
+		return
+	
+	# Logging waits for spare request budget, everything else goes first
+	priority = reddit_util.PRIORITY_LOGGING if action == "log" else reddit_util.PRIORITY_ACTION
+	try:
+		reddit_util.acquire(priority)
+	except RetryLater:
+		debug("Deferring {} on {}".format(action, fullname), extra=thing_fields(thing))
+		if fullname is not None and fullname[:3] in ("t1_", "t3_"):
+			remaining, reset = reddit_util.get_ratelimit()
+			job_queue.submit(_action_jobs, "action:{}:{}".format(fullname, key), fullname, max(reset, 1), payload=(action, results))
+		else:
+			_deferred_actions.append((action, results, thing, func, args, kwargs))
+		return
+	
+	func(*args, **kwargs)
+	if action_journal is not None and fullname is not None:
+		action_journal.record(fullname, key)
+
+def _result_digest(results):
+	import json
+	
+	# Must stay the same across restarts, so templates go in by their text
+	dumped = json.dumps(results[1], sort_keys=True, default=str)
+	return hashlib.sha1(dumped.encode("utf-8")).hexdigest()[:12]
+
+def perform_deferred_actions():
+	actions = list(_deferred_actions)
+	_deferred_actions.clear()
+	for action, results, thing, func, args, kwargs in actions:
+		_process_safely(lambda t: _perform(action, results, t, func, *args, **kwargs), thing)
+
 def _ban_author(messages, thing):
 	note = msg = None
 	dur = 0
@@ -299,12 +596,11 @@ def _ban_author(messages, thing):
 			msg = ban_info["message"]
 		if dict_exists(ban_info, "duration"):
 			dur = ban_info["duration"]
-	thing.subreddit.add_ban(thing.author, params={"note": note, "ban_message": msg, "duration": dur})
+	reddit_util.ban_user(r, config.subreddit, thing.author.name, note=note, message=msg, duration=dur)
 
-def _send_messages(messages, thing):
-	thing_info = _get_thing_info(thing)
+def _send_messages(messages, thing, context):
 	def fmt(text):
-		return safe_format(text, **thing_info)
+		return safe_format(text, context)
 	
 	if dict_exists(messages, "modmail"):
 		title = "[SpamShark] "+fmt(messages["modmail"][0])
@@ -317,9 +613,9 @@ def _send_messages(messages, thing):
 		if dict_exists(messages, "pm"):
 			#TODO: test this
 			author = thing.author.name
-			title = fmt(["pm"][0])
+			title = fmt(messages["pm"][0])
 			body = fmt(messages["pm"][1])
-			from_sr = thing.subreddit.display_name if len(messages["pm"]) > 2 and messages["pm"][2] and hasattr(thing, "subreddit") else None
+			from_sr = str(thing.subreddit) if len(messages["pm"]) > 2 and messages["pm"][2] and getattr(thing, "subreddit", None) else None
 			reddit_util.send_pm(r, author, title, body, from_sr=from_sr)
 
 def _flair_thing(messages, thing):
@@ -334,50 +630,96 @@ def _flair_thing(messages, thing):
 			flair_css = messages["flair_post"][1]
 			reddit_util.set_flair(r, config.subreddit, thing, flair_text, flair_css)
 
-def _log_result(messages, thing):
-	thing_info = _get_thing_info(thing)
+def _log_result(messages, context):
 	def fmt(text):
-		return safe_format(text, **thing_info)
+		return safe_format(text, context)
 	
 	if dict_exists(messages, "log") and not config.log_subreddit is None and len(config.log_subreddit) > 0:
 		title = fmt(messages["log"][0])
 		body = fmt(messages["log"][1])
 		reddit_util.submit_text_post(r, config.log_subreddit, title, body)
 
-def _get_thing_info(thing, link=None):
-	if reddit_util.is_post(thing):
-		return {
-			"author": "/u/"+thing.author.name,
-			"permalink": reddit_util.reduce_reddit_link(thing.permalink),
-			"title": thing.title,
-			"body": thing.selftext if thing.is_self else "",
-			"link": thing.url if not thing.is_self else "",
-			"subreddit": config.subreddit
-		}
-	if reddit_util.is_comment(thing):
-		resp = {
-			"author": "/u/"+thing.author.name,
-			"permalink": reddit_util.reduce_reddit_link(thing.permalink),
-			"body": thing.body,
-			"subreddit": config.subreddit
-		}
-		if link:
-			resp["link"] = link
-		return resp
-	if reddit_util.is_message(thing):
-		print("IT'S A MESSAGE!")
-		from pprint import pprint
-		pprint(vars(thing))
-		resp = {
-			"author": "/u/"+thing.author.name,
-			"permalink": reddit_util.reduce_reddit_link(thing.permalink),
-			"title": thing.title,
-			"body": thing.body,
-		}
-		if link:
-			resp["link"] = link
-		return resp
-	return {}
+class ThingContext(Mapping):
+	"""
+	Template values for a thing. Each value is only looked up when a template
+	uses it, then kept, so formatting doesn't touch (and possibly fetch) more
+	of the thing than needed.
+	"""
+	
+	def __init__(self, thing, link=None):
+		self.thing = thing
+		self.link = link
+		self._kind = None
+		self._values = {}
+	
+	def __getitem__(self, key):
+		if key in self._values:
+			return self._values[key]
+		
+		getter = getattr(self, "_get_"+key, None)
+		if getter is None:
+			raise KeyError(key)
+		try:
+			value = getter(self.kind)
+		except AttributeError:
+			raise KeyError(key)
+		self._values[key] = value
+		return value
+	
+	def __iter__(self):
+		return iter(("author", "permalink", "title", "body", "link", "subreddit"))
+	
+	def __len__(self):
+		return 6
+	
+	@property
+	def kind(self):
+		if self._kind is None:
+			if reddit_util.is_post(self.thing):
+				self._kind = "post"
+			elif reddit_util.is_comment(self.thing):
+				self._kind = "comment"
+			elif reddit_util.is_message(self.thing):
+				self._kind = "message"
+			else:
+				self._kind = "unknown"
+		return self._kind
+	
+	def _get_author(self, kind):
+		if kind == "unknown":
+			raise AttributeError
+		return "/u/"+self.thing.author.name
+	
+	def _get_permalink(self, kind):
+		if kind == "unknown":
+			raise AttributeError
+		return reddit_util.reduce_reddit_link(self.thing.permalink)
+	
+	def _get_title(self, kind):
+		if kind == "post":
+			return self.thing.title
+		if kind == "message":
+			return self.thing.subject
+		raise AttributeError
+	
+	def _get_body(self, kind):
+		if kind == "post":
+			return self.thing.selftext if self.thing.is_self else ""
+		if kind in ("comment", "message"):
+			return self.thing.body
+		raise AttributeError
+	
+	def _get_link(self, kind):
+		if kind == "post":
+			return self.thing.url if not self.thing.is_self else ""
+		if kind != "unknown" and self.link:
+			return self.link
+		raise AttributeError
+	
+	def _get_subreddit(self, kind):
+		if kind in ("post", "comment"):
+			return config.subreddit
+		raise AttributeError
 
 # Actual main
 
@@ -385,42 +727,232 @@ args = None
 running = True
 waitEvent = Event()
 
+_update_results = {}
+
 def update_filters():
-	def do_result(result_tuple):
-		if result_tuple and len(result_tuple) == 3:
-			process_filter_results((result_tuple[0], result_tuple[1]), result_tuple[2])
+	for results, thing in collect_updates():
+		_process_safely(lambda t: process_filter_results(results, t), thing)
 	
+	for results, thing in evaluate_deferred():
+		_process_safely(lambda t: process_filter_results(results, t), thing)
+
+def collect_updates():
+	"""
+	Runs the update step of every filter. Results are queued as they're
+	yielded, so those produced before a timeout aren't lost and an update
+	still running after one keeps delivering them to later passes.
+	Returns a list of (results, thing).
+	"""
+	collected = []
 	for ff in all_filters:
+		guard = filter_guards[ff.filter_id]
+		produced = _update_results.setdefault(ff.filter_id, Queue())
+		
 		try:
-			for result in ff.update():
-				do_result(result)
-			
+			guard.call(_run_update, ff, produced, budget=config.filter_update_budget)
+		except CircuitOpen:
+			pass
+		except FilterTimeout:
+			warning("Filter update timed out for {}".format(ff.filter_id), extra=thing_fields(filter_id=ff.filter_id))
 		except Exception as e:
-			ex_type, ex, tb = sys.exc_info()
-			print("Error: Filter update unexpectedly failed for {} ({})".format(ff.filter_id, e))
-			traceback.print_tb(tb)
-			del tb
+			error("Filter update unexpectedly failed for {} ({})".format(ff.filter_id, e), extra=thing_fields(filter_id=ff.filter_id))
+			exception(e)
+		
+		while not produced.empty():
+			result = produced.get_nowait()
+			if result and len(result) == 3:
+				collected.append(((result[0], result[1]), result[2]))
+	return collected
+
+def _run_update(f, produced):
+	for result in f.update():
+		produced.put(result)
+
+def evaluate_deferred():
+	"""
+	Re-evaluates things skipped while their filter was unavailable.
+	Returns a list of (results, thing) for things that got a result.
+	"""
+	evaluated = []
+	for ff in all_filters:
+		guard = filter_guards[ff.filter_id]
+		for method, method_args in guard.take_deferred():
+			results = run_filter(ff, method, *method_args)
+			if is_result(results):
+				evaluated.append((results, method_args[-1]))
+	return evaluated
+
+def run_jobs():
+	due = job_queue.pop_due()
+	if len(due) == 0:
+		return
+	
+	# One request per 100 jobs refreshes everything and drops things that
+	# don't need checking anymore, before filters spend API quota on them.
+	# Deferred actions still apply to things removed in the meantime.
+	filters = {f.filter_id: f for f in all_filters}
+	actions = [job for job in due if job.filter_id == _action_jobs]
+	checks = [job for job in due if job.filter_id != _action_jobs]
+	try:
+		acted = reddit_util.get_things(r, set(job.fullname for job in actions))
+		things = reddit_util.revalidate(r, set(job.fullname for job in checks), exclude=_was_removed)
+	except:
+		job_queue.restore(due)
+		raise
+	
+	def run_action(job, thing):
+		action, results = job.payload
+		process_filter_results(results, thing, only=action)
+	
+	def run_check(job, thing):
+		results = run_filter(filters[job.filter_id], "process_job", job, thing)
+		process_filter_results(results, thing)
+	
+	# A failing job doesn't take the others down with it, and if the whole
+	# pass has to stop, the jobs that didn't run yet are kept
+	done = set()
+	try:
+		for job in actions:
+			thing = acted.get(job.fullname)
+			if thing is not None:
+				_process_safely(lambda t: run_action(job, t), thing)
+			done.add(job.key)
+		
+		debug("Running {} delayed jobs, {} things still live".format(len(checks), len(things)))
+		for job in checks:
+			thing = things.get(job.fullname)
+			if job.filter_id in filters and thing is not None:
+				_process_safely(lambda t: run_check(job, t), thing)
+			done.add(job.key)
+	except:
+		job_queue.restore(job for job in due if not job.key in done)
+		raise
+
+def _was_removed(thing):
+	return action_journal is not None and action_journal.has(thing.fullname, "remove")
+
+def _process_things(kind, things, worker_pool):
+	if worker_pool is not None:
+		_evaluate_in_workers(worker_pool, kind, things)
+	else:
+		process = process_post if kind == "post" else process_comment
+		for thing in things:
+			_process_safely(process, thing)
+
+def _advance_watermark(watermarks, backfills, name, polled):
+	# Until the backlog is done, the old watermark is still where a restart has to catch up from
+	backfill = backfills.get(name)
+	if backfill is not None and not backfill.done:
+		backfill.seed(polled)
+		return
+	watermarks.advance(name, polled)
+
+def _evaluate_in_workers(pool, kind, things):
+	_process_from_workers(pool.evaluate(kind, things, r))
+
+def _process_from_workers(evaluated):
+	for kind, results, thing in evaluated:
+		_process_safely(lambda t: _finish_in_main(kind, results, t), thing)
+
+def _finish_in_main(kind, results, thing):
+	# Filters with shared state, and rate tracking, were left to this process
+	if kind == "post":
+		results = evaluate_post(thing, shared=True, results=results)
+	elif kind == "comment":
+		results = evaluate_comment(thing, shared=True, results=results)
+	process_filter_results(results, thing)
+
+def _process_safely(process, thing):
+	from praw.errors import ModeratorRequired, ModeratorOrScopeRequired
+	
+	# Keep one bad thing from aborting the rest of the pass
+	try:
+		process(thing)
+	except (ModeratorRequired, ModeratorOrScopeRequired):
+		raise
+	except Exception as e:
+		error("Failed to process {} ({})".format(thing.fullname, e), extra=thing_fields(thing))
+		exception(e)
 
 def process_loop():
+	from requests import HTTPError
+	from praw.errors import ModeratorRequired, ModeratorOrScopeRequired
+	
 	# Get reddit connection
-	global r
-	r = reddit_util.init_reddit_session()
+	global r, job_queue, rate_tracker, filter_stats, action_journal, config_revision
+	os.makedirs(config.cache_location, exist_ok=True)
+	snapshot = None
+	if args.once:
+		snapshot = load_cached_storage(config.snapshot_file, factory=lambda: Snapshot(file=config.snapshot_file))
+		r = reddit_util.resume_reddit_session(snapshot.session)
+	else:
+		r = reddit_util.init_reddit_session()
 	
 	# Create/load caches
-	os.makedirs(config.cache_location, exist_ok=True)
-	post_cache = load_cached_storage(config.cache_location+"/posts.cache")
-	comment_cache = load_cached_storage(config.cache_location+"/comments.cache")
+	post_cache = open_thing_cache("posts")
+	comment_cache = open_thing_cache("comments")
+	jobs_file = config.cache_location+"/jobs.cache"
+	job_queue = load_cached_storage(jobs_file, factory=lambda: JobQueue(file=jobs_file))
+	rates_file = config.cache_location+"/rates.cache"
+	rate_tracker = load_cached_storage(rates_file, factory=lambda: RateTracker(file=rates_file))
+	stats_file = config.cache_location+"/filter-stats.cache"
+	filter_stats = load_cached_storage(stats_file, factory=lambda: FilterStats(file=stats_file))
+	action_journal = ActionJournal(config.cache_location+"/actions.journal")
+	watermarks_file = config.cache_location+"/watermarks.cache"
+	watermarks = load_cached_storage(watermarks_file, factory=lambda: Watermarks(file=watermarks_file))
+	last_config_check = 0
+	last_save = time()
+	
+	# Pick up where the last --once run left off instead of reconfiguring
+	if snapshot is not None and snapshot.filter_configs is not None:
+		init_filters(configure=False)
+		snapshot.restore_filters(all_filters, config_hashes)
+		apply_filter_configs(snapshot.filter_configs)
+		config_revision = snapshot.config_revision
+		last_config_check = snapshot.last_config_check
+	
+	# Catch up on anything posted while the bot was down
+	backfills = {}
+	if config.backfill_max_age > 0:
+		for name, path in (("posts", "/r/{}/new"), ("comments", "/r/{}/comments")):
+			if watermarks.get(name) is not None:
+				backfills[name] = Backfill(name, path.format(config.subreddit), watermarks.get(name), config.backfill_max_age)
+	
+	# Polling intervals adapt to activity between the configured bounds
+	post_poller = polling.AdaptivePoller("posts", *config.poll_posts)
+	comment_poller = polling.AdaptivePoller("comments", *config.poll_comments)
+	inbox_poller = polling.AdaptivePoller("inbox", *config.poll_inbox)
+	pollers = [post_poller, comment_poller]
+	if not args.no_update:
+		pollers.append(inbox_poller)
+	
+	# Optionally evaluate posts and comments in worker processes
+	worker_pool = None
+	if config.worker_processes > 0:
+		import workers
+		info("Starting {} filter workers".format(config.worker_processes))
+		worker_pool = workers.WorkerPool(config.worker_processes, on_job=job_queue.submit,
+										 on_stats=filter_stats.record, stats=filter_stats.data())
+		worker_pool.start(reddit_util.get_session_state())
+		
+		# Filters restored from a snapshot were configured before the pool existed
+		if filter_configs is not None:
+			worker_pool.configure(filter_configs)
 	
 	# Go! Go! Go!
 	while running:
 		try:
 			r = reddit_util.renew_reddit_session(r)
+			if worker_pool is not None:
+				worker_pool.update_session(reddit_util.get_session_state())
 			
 			# Check for update messages
 			update = len(all_filters) == 0			# Guarantee update if on first iteration (assuming filters exist)
+			force_update = False
 			new_messages = list()
-			if not args.no_update:
-				unread = r.get_unread(limit=None)
+			if not args.no_update and (update or inbox_poller.poll()):
+				unread = list(r.get_unread(limit=None))
+				inbox_poller.record(len(unread), 5, reddit_util.ratelimit_spacing(1 + len(unread)))
 				for message in unread:
 					message.mark_as_read()
 					
@@ -428,42 +960,75 @@ def process_loop():
 						if message.body == "update" \
 								and (len(config.config_whitelist) == 0 or message.author.name.lower() in config.config_whitelist):
 							info("Update message received from {}".format(message.author.name))
-							update = True
+							update = force_update = True
 						else:
 							new_messages.append(message)
+				
+			# Cheaply poll the wiki revision in case nobody sent an update message
+			if not args.no_update and time() - last_config_check >= config.config_poll_interval:
+				update = True
 			
 			# Initialize filters if non-initialized or requested
 			if update:
-				init_filters()
+				configs = init_filters(force=force_update)
+				if configs is not None and worker_pool is not None:
+					worker_pool.configure(configs)
+				last_config_check = time()
 			
 			# Let filters do their update things
 			update_filters()
+			if worker_pool is not None:
+				_process_from_workers(worker_pool.collect(r))
+			run_jobs()
+			perform_deferred_actions()
 			
 			# Do some moderation!
-			subreddit = r.get_subreddit(config.subreddit)
-			
 			## Messages
 			for message in new_messages:
-				process_message(message)
+				_process_safely(process_message, message)
 			new_messages.clear()
 			
 			## Posts
-			debug("Processing posts")
-			new_posts = reddit_util.get_all_new(subreddit)
-			new_posts = post_cache.get_diff(new_posts)
-			for post in new_posts:
-				process_post(post)
-			debug("Done processing posts")
+			if post_poller.poll() and reddit_util.has_budget(reddit_util.PRIORITY_LISTING, 2):
+				debug("Processing posts")
+				polled = reddit_util.get_all_new(r, config.subreddit)
+				new_posts = post_cache.get_diff(polled)
+				post_poller.record(len(new_posts), 100, reddit_util.ratelimit_spacing(2))
+				_process_things("post", new_posts, worker_pool)
+				_advance_watermark(watermarks, backfills, "posts", polled)
+				debug("Done processing posts")
 			
 			## Comments
-			debug("Processing comments")
-			new_comments = reddit_util.get_all_comments(subreddit)
-			new_comments = comment_cache.get_diff(new_comments)
-			for comment in new_comments:
-				process_comment(comment)
-			debug("Done processing comments")
+			if comment_poller.poll() and reddit_util.has_budget(reddit_util.PRIORITY_LISTING, 3):
+				debug("Processing comments")
+				polled = reddit_util.get_new_comments(r, config.subreddit)
+				new_comments = comment_cache.get_diff(polled)
+				comment_poller.record(len(new_comments), 100, reddit_util.ratelimit_spacing(3))
+				_process_things("comment", new_comments, worker_pool)
+				_advance_watermark(watermarks, backfills, "comments", polled)
+				debug("Done processing comments")
+			
+			## Backlog, a few pages per pass (all of it when running once)
+			for kind, name, cache in (("post", "posts", post_cache), ("comment", "comments", comment_cache)):
+				backfill = backfills.get(name)
+				while backfill is not None and not backfill.done \
+						and reddit_util.has_budget(reddit_util.PRIORITY_HISTORY, config.backfill_pages):
+					_process_things(kind, cache.get_diff(backfill.next_batch(r, config.backfill_pages)), worker_pool)
+					if not args.once:
+						break
 			
-			if running and waitEvent.wait(timeout=20):
+			# The rate tracker is too big to save on every change
+			if time() - last_save >= 300:
+				rate_tracker.save()
+				filter_stats.save()
+				watermarks.save()
+				job_queue.save()
+				http_util.log_stats()
+				last_save = time()
+			
+			# Filter updates still get to run at least every 20 seconds
+			wait = min(polling.next_poll(pollers) - time(), 20)
+			if running and not args.once and waitEvent.wait(timeout=max(wait, 0)):
 				break
 			
 		except (ModeratorRequired, ModeratorOrScopeRequired, HTTPError) as e:
@@ -482,15 +1047,34 @@ def process_loop():
 			error("Error: {}".format(e))
 			#traceback.print_tb(tb)
 			exception(e)
+		
+		if args.once:
+			break
+	
+	if worker_pool is not None:
+		worker_pool.stop()
 	
 	post_cache.save()
 	comment_cache.save()
+	job_queue.save()
+	rate_tracker.save()
+	filter_stats.save()
+	watermarks.save()
+	action_journal.close()
+	
+	if snapshot is not None:
+		snapshot.session = reddit_util.get_session_state()
+		snapshot.config_revision = config_revision
+		snapshot.last_config_check = last_config_check
+		snapshot.filter_configs = filter_configs
+		snapshot.capture_filters(all_filters, config_hashes)
+		snapshot.save()
 
 def main():
 	build_local_config()
 	
 	# Start
-	if args.no_input:
+	if args.no_input or args.once:
 		process_loop()
 	else:
 		processing_thread = Thread(target=process_loop, name="SpamShark-process-thread")
@@ -530,35 +1114,43 @@ def main():
 		processing_thread.join()
 	
 	# Clean up
-	info("Saving and cleaning up...", end=" ")
-	reddit_util.destroy_reddit_session(r)
+	info("Saving and cleaning up...")
+	if not args.once:
+		# Keep the token valid for the next run
+		reddit_util.destroy_reddit_session(r)
 	
-	info("done!")
+	info("Done!")
 
 #############
 # Utilities #
 #############
 
-_link_pattern = re.compile("((?:[a-z]+://)?(?:[a-z0-9]+\.)+[a-z]{2,}(?:[^)\]}\* \t\r\n]*)?)", flags=re.IGNORECASE)
-
 def extract_submission_links(markdown_text):
-	matched = _link_pattern.findall(markdown_text)
-	
-	links = []
-	for link in matched:
-		links.append(link)
-	
-	return links
+	return text_util.extract_links(markdown_text)
 
 def fake_isinstance(obj_cls, cls):
 	return isinstance(obj_cls, cls) or cls.__name__ in list(map(lambda c: c.__name__, inspect.getmro(obj_cls)))
 
-class _SafeDict(dict):
-	def __missing__(self, key):
-		return '{' + key + '}'
+@lru_cache(maxsize=512)
+def get_template(text):
+	return Template(text)
 
-def safe_format(text, **kwargs):
-	return text.format_map(_SafeDict(kwargs))
+def safe_format(text, context=None, **kwargs):
+	"""
+	Formats a template (text or Template) with the given values and/or
+	context mapping, leaving unknown placeholders in place. Only text
+	formatted without a context is cached, since that's the raw templates
+	filters fill in; text formatted with a thing's context has usually been
+	filled in already and is different every time.
+	"""
+	if context is None:
+		template = text if isinstance(text, Template) else get_template(text)
+		return template.format(kwargs)
+	
+	template = text if isinstance(text, Template) else Template(text)
+	if len(kwargs) == 0:
+		return template.format(context)
+	return template.format(ChainMap(kwargs, context))
 
 def dict_exists(messages, name):
 	return name in messages and not messages[name] is None
@@ -572,34 +1164,33 @@ if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description="SpamShark, modular reddit moderation bot")
 	parser.add_argument("--no-input", action="store_true", help="run in a single thread without stdin")
 	parser.add_argument("--no-update", action="store_true", help="run without checking for config update messages")
+	parser.add_argument("--once", action="store_true", help="run a single pass from the saved snapshot and exit (for cron)")
 	parser.add_argument("--list-filters", action="store_true", help="list available filters")
 	parser.add_argument("-v", "--version", action="version", version="SpamShark "+version)
 	args = parser.parse_args()
 	
-	if args.no_input:
-		from datetime import datetime
-		log_file = datetime.now().strftime("%Y-%m-%dT%H:%M:%S") + ".log"
-		logging.basicConfig(
-			format="%(asctime)s | %(levelname)s | %(message)s",
-			datefmt="%Y-%m-%d %H:%M:%S",
-			level=logging.INFO, filename=log_file)
-	else:
-		logging.basicConfig(format="%(levelname)s | %(message)s", level=logging.INFO)
+	# Records are written off the processing thread, as JSON lines when logging to a file
+	import log_util
+	log_file = config.log_file if args.no_input or args.once else None
+	log_util.init_logging(log_file, max_bytes=config.log_max_bytes, backup_count=config.log_backups)
 	logging.getLogger("requests").setLevel(logging.WARNING)
 	
 	if args.list_filters:
-		filters = get_filters()
+		filters = list_filters()
 		print("Available filters:\n------------------")
 		for i, f in enumerate(filters):
 			print("{}. {}".format(i+1, f.filter_id), end="")
-			if hasattr(f, "filter_name"):
-				print(": {}".format(f.filter_name))
+			if not f.name is None:
+				print(": {}".format(f.name))
 			else:
 				print()
-			if hasattr(f, "filter_descr") and not f.filter_descr is None:
-				print("   {}".format(f.filter_descr))
-			if hasattr(f, "filter_author") and not f.filter_author is None:
-				print("   Created by {}".format(f.filter_author))
+			if len(f.types) > 0:
+				print("   Filters: {}".format(", ".join(f.types)))
+			if not f.descr is None:
+				print("   {}".format(f.descr))
+			if not f.author is None:
+				print("   Created by {}".format(f.author))
 			print()
 	else:
 		main()
+	log_util.stop_logging()
@@ -0,0 +1,207 @@
+from collections import deque
+import random, re, zlib, string
+
+# Phrase matching
+
+class PhraseMatcher:
+	"""
+	Aho-Corasick automaton matching any number of phrases in a single pass over
+	the text, so scanning cost doesn't grow with the number of phrases.
+	Phrases are matched case-insensitively.
+	"""
+	
+	def __init__(self):
+		self._goto = [{}]
+		self._fail = [0]
+		self._out = [[]]
+		self._out_link = [0]
+		self._built = False
+	
+	def add(self, phrase, value):
+		phrase = _lower(phrase)
+		state = 0
+		for ch in phrase:
+			next_state = self._goto[state].get(ch)
+			if next_state is None:
+				next_state = len(self._goto)
+				self._goto[state][ch] = next_state
+				self._goto.append({})
+				self._fail.append(0)
+				self._out.append([])
+				self._out_link.append(0)
+			state = next_state
+		self._out[state].append((len(phrase), value))
+		self._built = False
+	
+	def build(self):
+		queue = deque(self._goto[0].values())
+		while len(queue) > 0:
+			state = queue.popleft()
+			for ch, next_state in self._goto[state].items():
+				queue.append(next_state)
+				fail = self._fail[state]
+				while fail > 0 and ch not in self._goto[fail]:
+					fail = self._fail[fail]
+				fail = self._goto[fail].get(ch, 0)
+				self._fail[next_state] = fail
+				# Link to the nearest suffix state that has outputs
+				self._out_link[next_state] = fail if len(self._out[fail]) > 0 else self._out_link[fail]
+		self._built = True
+	
+	def __len__(self):
+		return len(self._goto) - 1
+	
+	def finditer(self, text):
+		"""
+		Yields (start, end, value) for every phrase occurrence in the text.
+		"""
+		if not self._built:
+			self.build()
+		
+		goto, fail, out, out_link = self._goto, self._fail, self._out, self._out_link
+		state = 0
+		for i, ch in enumerate(_lower(text)):
+			while state > 0 and ch not in goto[state]:
+				state = fail[state]
+			state = goto[state].get(ch, 0)
+			
+			match_state = state
+			while match_state > 0:
+				for length, value in out[match_state]:
+					yield i - length + 1, i + 1, value
+				match_state = out_link[match_state]
+
+def _lower(text):
+	# Offsets into the lowered text must match the original, so characters
+	# that lowercase to more than one (e.g. "İ") are left alone
+	lowered = text.lower()
+	if len(lowered) == len(text):
+		return lowered
+	return "".join(ch.lower() if len(ch.lower()) == 1 else ch for ch in text)
+
+def is_whole_word(text, start, end):
+	return (start == 0 or not text[start-1].isalnum()) and (end == len(text) or not text[end].isalnum())
+
+# Near-duplicate detection
+
+_word_pattern = re.compile("\\w+")
+_hash_prime = (1 << 61) - 1
+
+def shingles(text, size=2):
+	"""
+	Returns the set of hashed word n-grams in the text.
+	"""
+	words = _word_pattern.findall(text.lower())
+	if len(words) <= size:
+		return {zlib.crc32(" ".join(words).encode("utf-8"))}
+	return {zlib.crc32(" ".join(words[i:i+size]).encode("utf-8")) for i in range(len(words) - size + 1)}
+
+class MinHasher:
+	"""
+	Computes MinHash signatures, whose fraction of equal values estimates the
+	Jaccard similarity of two shingle sets.
+	"""
+	
+	def __init__(self, num_perm=64, seed=1):
+		rng = random.Random(seed)
+		self.num_perm = num_perm
+		self._perms = [(rng.randrange(1, _hash_prime), rng.randrange(0, _hash_prime)) for n in range(num_perm)]
+	
+	def signature(self, shingle_set):
+		p = _hash_prime
+		return tuple(min([(a * h + b) % p for h in shingle_set]) for a, b in self._perms)
+
+def estimate_similarity(sig_a, sig_b):
+	same = sum(1 for a, b in zip(sig_a, sig_b) if a == b)
+	return same / len(sig_a)
+
+# Link extraction
+# Equivalent to findall with ((?:[a-z]+://)?(?:[a-z0-9]+\.)+[a-z]{2,}(?:[^)\]}\* \t\r\n]*)?)
+# (case-insensitive), but in linear time. The regex backtracks quadratically
+# over long runs of letters and dots, which anyone can post.
+
+_alnum_run = re.compile("[a-z0-9]+", flags=re.IGNORECASE)
+_letter = re.compile("[a-z]", flags=re.IGNORECASE)
+_tld = re.compile("[a-z]{2}", flags=re.IGNORECASE)
+_link_end = re.compile("[)\\]}* \t\r\n]")
+
+def extract_links(text):
+	runs = [(m.start(), m.end()) for m in _alnum_run.finditer(text)]
+	
+	# A host can start in a run if it's followed by a dot, then either a TLD
+	# or another run a host can start in
+	host_ok = [False] * (len(runs) + 1)
+	for i in range(len(runs) - 1, -1, -1):
+		end = runs[i][1]
+		if end < len(text) and text[end] == "." and i + 1 < len(runs) and runs[i+1][0] == end + 1:
+			host_ok[i] = bool(_tld.match(text, end + 1)) or host_ok[i+1]
+	
+	links = []
+	pos = 0
+	for i, (start, end) in enumerate(runs):
+		if start < pos:
+			continue
+		
+		if host_ok[i]:
+			host_start = start
+		elif text.startswith("://", end) and i + 1 < len(runs) and runs[i+1][0] == end + 3 and host_ok[i+1]:
+			# Scheme, only the letters right before the "://"
+			host_start = end + 3
+			while end > start and _letter.match(text, end - 1):
+				end -= 1
+			if end == runs[i][1]:
+				continue
+			start = end
+		else:
+			continue
+		
+		link_end = _link_end.search(text, host_start)
+		pos = link_end.start() if link_end is not None else len(text)
+		links.append(text[start:pos])
+	return links
+
+# Message templates
+
+class Template:
+	"""
+	Message template parsed once and formatted any number of times.
+	Placeholders without a value are left in place, so a template can be
+	filled in stages (e.g. by a filter, then with the thing's context).
+	Kept here rather than in spam_shark, which runs as __main__ and is loaded
+	a second time when filters import it.
+	"""
+	
+	_formatter = string.Formatter()
+	
+	def __init__(self, text):
+		self.text = text
+		self._parts = list(self._formatter.parse(text))
+	
+	def format(self, values):
+		out = []
+		for literal, field, spec, conversion in self._parts:
+			out.append(literal)
+			if field is None:
+				continue
+			
+			placeholder = "{"+field+("!"+conversion if conversion else "")+(":"+spec if spec else "")+"}"
+			if not field.isidentifier() or "{" in spec:
+				# Attribute/index lookups and nested specs are rare enough for the slow path
+				try:
+					out.append(placeholder.format_map(values))
+				except (KeyError, AttributeError, IndexError, ValueError):
+					out.append(placeholder)
+				continue
+			
+			try:
+				value = values[field]
+			except KeyError:
+				out.append(placeholder)
+				continue
+			if conversion:
+				value = {"r": repr, "s": str, "a": ascii}[conversion](value)
+			out.append(format(value, spec))
+		return "".join(out)
+	
+	def __str__(self):
+		return self.text
@@ -0,0 +1,111 @@
+# Thing snapshots
+# Posts and comments are read straight from listing JSON into small immutable
+# records instead of praw objects. They hold everything filters look at, never
+# fetch anything when an attribute is read, and pickle cheaply. Actions on them
+# go through reddit_util by fullname.
+
+_reddit_url = "https://www.reddit.com"
+
+class Author:
+	__slots__ = ("name",)
+	
+	def __init__(self, name):
+		object.__setattr__(self, "name", name)
+	
+	def __setattr__(self, key, value):
+		raise AttributeError("Authors are immutable")
+	
+	def __reduce__(self):
+		return Author, (self.name,)
+	
+	def __eq__(self, other):
+		return isinstance(other, Author) and self.name == other.name
+	
+	def __hash__(self):
+		return hash(self.name)
+	
+	def __str__(self):
+		return self.name
+
+class Thing:
+	__slots__ = ("kind", "id", "fullname", "author", "subreddit", "created_utc", "permalink",
+				 "title", "url", "is_self", "selftext", "selftext_html", "body", "link_id",
+				 "banned_by", "approved_by", "thumbnail")
+	
+	def __init__(self, **fields):
+		for name in self.__slots__:
+			object.__setattr__(self, name, fields.get(name))
+	
+	@classmethod
+	def from_json(cls, child):
+		"""
+		Builds a snapshot from a listing child ({"kind": ..., "data": {...}}).
+		"""
+		kind = child["kind"]
+		data = child["data"]
+		author = data.get("author")
+		
+		fields = {
+			"kind": kind,
+			"id": data["id"],
+			"fullname": data.get("name") or kind+"_"+data["id"],
+			"author": Author(author) if author and author != "[deleted]" else None,
+			"subreddit": data.get("subreddit"),
+			"created_utc": data.get("created_utc"),
+			"banned_by": data.get("banned_by"),
+			"approved_by": data.get("approved_by")
+		}
+		
+		if kind == "t3":
+			fields.update({
+				"title": data.get("title"),
+				"url": data.get("url"),
+				"is_self": data.get("is_self", False),
+				"selftext": data.get("selftext", ""),
+				"selftext_html": data.get("selftext_html"),
+				"thumbnail": data.get("thumbnail")
+			})
+		else:
+			fields.update({
+				"body": data.get("body", ""),
+				"link_id": data.get("link_id")
+			})
+		
+		permalink = data.get("permalink")
+		if permalink is None and kind == "t1" and fields["link_id"] is not None:
+			permalink = "/r/{}/comments/{}/_/{}/".format(fields["subreddit"], fields["link_id"][3:], fields["id"])
+		if permalink is not None and permalink.startswith("/"):
+			permalink = _reddit_url+permalink
+		fields["permalink"] = permalink
+		
+		return cls(**fields)
+	
+	def __setattr__(self, key, value):
+		raise AttributeError("Thing snapshots are immutable")
+	
+	def __reduce__(self):
+		return _restore, (Thing, tuple(getattr(self, name) for name in self.__slots__))
+	
+	@property
+	def is_post(self):
+		return self.kind == "t3"
+	
+	@property
+	def is_comment(self):
+		return self.kind == "t1"
+	
+	# Actions
+	
+	def remove(self, spam=False):
+		import reddit_util
+		reddit_util.remove(reddit_util.session, self.fullname, spam=spam)
+	
+	def report(self, reason=None):
+		import reddit_util
+		reddit_util.report(reddit_util.session, self.fullname, reason=reason)
+	
+	def __repr__(self):
+		return "<Thing {}>".format(self.fullname)
+
+def _restore(cls, values):
+	return cls(**dict(zip(cls.__slots__, values)))
@@ -0,0 +1,281 @@
+from queue import Empty
+from time import time
+import multiprocessing, os, copy, zlib
+import logging
+
+# Filter evaluation in worker processes
+# Things are sharded by author so per-author filter state stays in one process.
+# Workers only evaluate filters, all actions are still taken by the main process.
+# Filters with state across authors (shared_state) and rate tracking run in the
+# main process too, after a worker's filters.
+# Workers reuse the main process's oauth token and draw from its request budget.
+# Workers are spawned and import config.py afresh, so the main process's config
+# values are passed along to keep anything changed at runtime.
+
+class WorkerPool:
+	def __init__(self, processes, on_job=None, on_stats=None, stats=None, timeout=120):
+		self.size = processes
+		self.on_job = on_job
+		self.on_stats = on_stats
+		self.stats = stats
+		self.timeout = timeout
+		self.configs = None
+		self.session = None
+		
+		self._context = multiprocessing.get_context("spawn")
+		self._results = self._context.Queue()
+		self._inboxes = [None] * processes
+		self._processes = [None] * processes
+		self._ratelimit = None
+		self._config = None
+		self._log_queue = None
+		self._log_level = logging.INFO
+		self._pending = {}
+		self._seq = 0
+	
+	def start(self, session=None):
+		import reddit_util, log_util
+		
+		self.session = session
+		self._log_queue = log_util.share_logging(self._context)
+		self._log_level = logging.getLogger().level
+		self._ratelimit = reddit_util.share_ratelimit()
+		self._config = _config_values()
+		for i in range(self.size):
+			self._start_worker(i)
+	
+	def stop(self):
+		for i in range(self.size):
+			if self._processes[i] is not None and self._processes[i].is_alive():
+				self._inboxes[i].put(None)
+		for process in self._processes:
+			if process is not None:
+				process.join(timeout=10)
+	
+	def configure(self, configs):
+		self.configs = configs
+		for inbox in self._inboxes:
+			inbox.put(("configure", configs))
+	
+	def update_session(self, session):
+		"""
+		Hands a renewed oauth token to the workers.
+		"""
+		if session == self.session:
+			return
+		self.session = session
+		for inbox in self._inboxes:
+			inbox.put(("session", session))
+	
+	def evaluate(self, kind, things, r):
+		"""
+		Sends things to the workers and yields (kind, results, thing) as results
+		stream back, including late results from earlier passes, and with kind
+		None, results of deferred things and filter updates. Those are
+		reattached to the given reddit session. Things still pending when the
+		timeout runs out are kept and their results are yielded by a later call.
+		Evaluated things are yielded even without a result, so the main process
+		can run the filters it keeps to itself.
+		"""
+		self._restart_dead()
+		
+		waiting = set()
+		for thing in things:
+			self._seq += 1
+			self._pending[self._seq] = kind, thing
+			waiting.add(self._seq)
+			self._inboxes[self._shard(thing)].put((kind, self._seq, _detach(thing)))
+		
+		while True:
+			try:
+				if len(waiting) > 0:
+					msg = self._results.get(timeout=self.timeout)
+				else:
+					msg = self._results.get_nowait()
+			except Empty:
+				if len(waiting) > 0:
+					logging.warning("Workers didn't evaluate {} {}s in time, {} things still pending".format(len(waiting), kind, len(self._pending)))
+				return
+			
+			msg_type = msg[0]
+			if msg_type == "result":
+				seq, results = msg[1], msg[2]
+				waiting.discard(seq)
+				entry = self._pending.pop(seq, None)
+				if entry is not None:
+					yield entry[0], results, entry[1]
+			elif msg_type == "deferred":
+				yield None, msg[1], _attach(msg[2], r)
+			elif msg_type == "job" and self.on_job is not None:
+				self.on_job(*msg[1])
+			elif msg_type == "stats" and self.on_stats is not None:
+				for record in msg[1]:
+					self.on_stats(*record)
+	
+	def collect(self, r):
+		"""
+		Yields (kind, results, thing) for whatever the workers have already
+		sent, without waiting.
+		"""
+		return self.evaluate(None, [], r)
+	
+	def _shard(self, thing):
+		author = thing.author.name.lower() if thing.author is not None else ""
+		return zlib.crc32(author.encode("utf-8")) % self.size
+	
+	def _start_worker(self, i):
+		self._inboxes[i] = self._context.Queue()
+		args = (i, self._inboxes[i], self._results, self._config, self._ratelimit, self.session, dict(self.stats or {}),
+				self._log_queue, self._log_level)
+		process = self._context.Process(target=_worker_main, args=args,
+										name="SpamShark-worker-{}".format(i), daemon=True)
+		process.start()
+		self._processes[i] = process
+		if self.configs is not None:
+			self._inboxes[i].put(("configure", self.configs))
+		
+		# Things a dead worker didn't get to go to its replacement
+		for seq, (kind, thing) in self._pending.items():
+			if self._shard(thing) == i:
+				self._inboxes[i].put((kind, seq, _detach(thing)))
+	
+	def _restart_dead(self):
+		for i, process in enumerate(self._processes):
+			if process is None or not process.is_alive():
+				logging.warning("Restarting filter worker {}".format(i))
+				self._start_worker(i)
+
+class _RemoteJobs:
+	"""
+	Stands in for the job queue in workers, forwarding jobs to the main process.
+	"""
+	
+	def __init__(self, results):
+		self._results = results
+	
+	def submit(self, *args):
+		self._results.put(("job", args))
+		return True
+
+class _RemoteStats:
+	"""
+	Stands in for filter stats in workers. Filters are ordered by a copy of the
+	main process's stats, and measurements are forwarded to it.
+	"""
+	
+	def __init__(self, stats, results):
+		self._stats = stats
+		self._results = results
+		self._records = []
+	
+	def record(self, *args):
+		self._stats.record(*args)
+		self._records.append(args)
+	
+	def order(self, *args):
+		return self._stats.order(*args)
+	
+	def flush(self):
+		if len(self._records) > 0:
+			self._results.put(("stats", self._records))
+			self._records = []
+
+_config_types = (str, int, float, bool, list, tuple, dict, set, frozenset, type(None))
+
+def _config_values():
+	import config
+	return {name: value for name, value in vars(config).items()
+			if not name.startswith("_") and isinstance(value, _config_types)}
+
+def _worker_main(index, inbox, results, config_values, ratelimit, session, stats, log_queue, log_level, update_interval=20):
+	import config, reddit_util, spam_shark, log_util
+	from ordering import FilterStats
+	
+	if log_queue is not None:
+		log_util.init_worker_logging(log_queue, log_level)
+	vars(config).update(config_values)
+	
+	# Filter-owned caches must not clash with other processes
+	config.cache_location = os.path.join(config.cache_location, "worker-{}".format(index))
+	os.makedirs(config.cache_location, exist_ok=True)
+	
+	spam_shark.build_local_config()
+	reddit_util.share_ratelimit(ratelimit)
+	spam_shark.r = reddit_util.resume_reddit_session(session)
+	spam_shark.job_queue = _RemoteJobs(results)
+	# Rates and filters with shared state are left to the main process,
+	# which sees every thing
+	spam_shark.rate_tracker = None
+	worker_stats = FilterStats()
+	worker_stats.data().update(stats)
+	spam_shark.filter_stats = _RemoteStats(worker_stats, results)
+	spam_shark.init_filters(configure=False)
+	
+	evaluators = {"post": lambda thing: spam_shark.evaluate_post(thing, shared=False),
+				  "comment": lambda thing: spam_shark.evaluate_comment(thing, shared=False)}
+	last_update = time()
+	while True:
+		try:
+			msg = inbox.get(timeout=update_interval)
+		except Empty:
+			msg = ()
+		if msg is None:
+			break
+		
+		kind = msg[0] if len(msg) > 0 else None
+		if kind == "configure":
+			spam_shark.apply_filter_configs(msg[1])
+		elif kind == "session":
+			spam_shark.r = reddit_util.resume_reddit_session(msg[1])
+		elif kind in evaluators:
+			seq, thing = msg[1], _attach(msg[2], spam_shark.r)
+			try:
+				thing_results = evaluators[kind](thing)
+			except Exception as e:
+				logging.exception(e)
+				thing_results = False
+			spam_shark.filter_stats.flush()
+			results.put(("result", seq, thing_results))
+		
+		# Filter updates run on the same schedule as in the main process
+		if time() - last_update >= update_interval:
+			for thing_results, thing in spam_shark.collect_updates():
+				results.put(("deferred", thing_results, _detach(thing)))
+			last_update = time()
+		
+		# Retry deferred things while there's nothing else to do
+		if inbox.empty():
+			for thing_results, thing in spam_shark.evaluate_deferred():
+				results.put(("deferred", thing_results, _detach(thing)))
+		spam_shark.filter_stats.flush()
+
+# praw objects hold their session, which is expensive to pickle and useless in
+# another process, so it's stripped before sending and restored on arrival.
+# Thing snapshots don't hold one and are sent as they are.
+
+def _detach(thing):
+	from praw.objects import RedditContentObject
+	from things import Thing
+	
+	if isinstance(thing, Thing):
+		return thing
+	thing = copy.copy(thing)
+	thing.__dict__["reddit_session"] = None
+	for name, value in list(vars(thing).items()):
+		if isinstance(value, RedditContentObject):
+			value = copy.copy(value)
+			value.__dict__["reddit_session"] = None
+			thing.__dict__[name] = value
+	return thing
+
+def _attach(thing, r):
+	from praw.objects import RedditContentObject
+	from things import Thing
+	
+	if isinstance(thing, Thing):
+		return thing
+	thing.__dict__["reddit_session"] = r
+	for value in vars(thing).values():
+		if isinstance(value, RedditContentObject):
+			value.__dict__["reddit_session"] = r
+	return thing